@@ -1,16 +1,31 @@
 from dotenv import load_dotenv
 load_dotenv()
 import setuptools
-import os, random
-from datetime import date
+import os, random, time, threading, hashlib, hmac, json, math, mimetypes, gzip
+import fcntl, mmap, stat, struct, tempfile
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from functools import wraps
-from flask import Flask, request, jsonify, render_template_string, redirect, g,session
-from flask_socketio import SocketIO, emit
+from flask import Flask, request, jsonify, render_template_string, redirect, g,session, make_response, \
+    url_for, send_from_directory, abort, Response
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_compress import Compress
+import psycopg
 from psycopg_pool import ConnectionPool
 from psycopg.rows import dict_row
 import atexit
 import razorpay
+import numpy as np
+from geo import KM_PER_DEG, RouteGeometry, FleetGeometry, GridIndex, encode_polyline, project_fleet, \
+    fast_distance_km
+from gpsfilter import GpsFilter, gps_speed, valid_position
+from wire import encode_text
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 razor_client = razorpay.Client(auth=(
     os.getenv("RAZORPAY_KEY_ID"),
@@ -32,6 +47,8 @@ else:
 # ================= APP =================
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "super-secret-key")
+# streamed responses (trip replay) would be buffered whole to compress them
+app.config["COMPRESS_STREAMS"] = False
 Compress(app)
 
 # ✅ PERFECT SocketIO Configuration
@@ -84,6 +101,511 @@ def admin_required(f):
     wrap.__name__ = f.__name__
     return wrap
 
+def staff_required(f):
+    # admin / office / conductor accounts logged in through /login
+    def wrap(*a,**k):
+        if not session.get("user_logged_in"):
+            return jsonify({"ok": False, "error": "Login required"}), 403
+        return f(*a,**k)
+    wrap.__name__ = f.__name__
+    return wrap
+
+# ================= SINGLE FLIGHT =================
+# During a sale dozens of requests ask for the same seat map at the same
+# moment. Identical in-flight reads share one DB execution: the first caller
+# runs the loader, everyone else with the same key waits for its result.
+# Pool pressure then grows with distinct keys, not with users.
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, wait_timeout=30):
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                return fn()  # leader is stuck, don't pile up behind it
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+                self.executed += 1
+            call.done.set()
+
+    def stats(self):
+        return {"executed": self.executed, "shared": self.shared, "in_flight": len(self._calls)}
+
+
+reads = SingleFlight()
+
+# ================= SHARED CACHE =================
+# Every gunicorn worker used to keep its own caches, splitting hit rates N
+# ways. With SHARED_CACHE_DIR set (ideally on tmpfs, e.g. /dev/shm/mybus) the
+# data version counters live in one mmap'ed file and anonymous page bodies /
+# reference data are plain files in that directory. Workers read them with a
+# normal open()+read() (page cache), no IPC round-trip. Whatever is in there
+# is trusted, so the directory must be ours and writable by nobody else.
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR")
+SHARED_CACHE_BYTES = int(os.getenv("SHARED_CACHE_BYTES", 64 * 1024 * 1024))
+if not SHARED_CACHE_DIR and int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+    # per-worker version counters would give every worker its own ETags
+    SHARED_CACHE_DIR = os.path.join(tempfile.gettempdir(), f"mybus-shared-{os.getuid()}")
+
+
+def private_dir(path):
+    """Create `path` with mode 0700; refuse one another user owns or can write to."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise RuntimeError(f"{path} must be a directory owned by this user and not "
+                           f"writable by group or others")
+    return path
+
+
+class SharedCounters:
+    """Fixed slots of uint64 counters in an mmap'ed file, shared by all workers."""
+
+    SLOTS = ("bookings", "gps_online")
+    HEADER = 16  # random token, lets ETags agree between workers
+
+    def __init__(self, path):
+        size = self.HEADER + 8 * len(self.SLOTS)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+                os.pwrite(fd, os.urandom(self.HEADER), 0)
+            self._fd = fd
+            self._map = mmap.mmap(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.token = self._map[:self.HEADER].hex()[:12]
+        # flock only excludes other processes: threads of this worker share the fd
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        return struct.unpack_from("<Q", self._map, self.HEADER + 8 * self.SLOTS.index(name))[0]
+
+    def incr(self, name):
+        offset = self.HEADER + 8 * self.SLOTS.index(name)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                struct.pack_into("<Q", self._map, offset, struct.unpack_from("<Q", self._map, offset)[0] + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class LocalCounters:
+    def __init__(self):
+        self.token = f"{os.getpid():x}{int(time.time()):x}"
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, name):
+        return self._values.get(name, 0)
+
+    def incr(self, name):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + 1
+
+
+class SharedFileCache:
+    """Size-bounded directory of cache entries, written with atomic renames."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        private_dir(directory)
+        self._written = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        self._written += len(data)
+        if self._written > self.max_bytes // 8:
+            self._written = 0
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.is_file() and not e.name.startswith(".tmp"):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                self.evicted += 1
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"dir": self.directory, "hits": self.hits, "misses": self.misses, "evicted": self.evicted}
+
+
+if SHARED_CACHE_DIR:
+    private_dir(SHARED_CACHE_DIR)
+    version_store = SharedCounters(os.path.join(SHARED_CACHE_DIR, "versions.bin"))
+    shared_cache = SharedFileCache(os.path.join(SHARED_CACHE_DIR, "entries"), SHARED_CACHE_BYTES)
+    print(f"✅ Shared cache at {SHARED_CACHE_DIR}")
+else:
+    version_store = LocalCounters()
+    shared_cache = None
+
+# ================= DATA VERSIONS / ETAG =================
+# Public pages only change when the data behind them changes. Each page names
+# the versions it depends on and its ETag is built from them, so a matching
+# If-None-Match is answered with 304 before any query or compression runs.
+REF_DATA_TTL = int(os.getenv("REF_DATA_TTL", 300))
+BOOT_ID = version_store.token
+
+_gps_seen = set()
+_reference_cache = {}
+
+
+def data_version(name):
+    if name == "ref":
+        # routes / schedules / stations are edited outside this app (admin.py,
+        # scripts), so the reference version simply rolls over every REF_DATA_TTL
+        return int(time.time() // REF_DATA_TTL)
+    return version_store.get(name)
+
+
+def bump_version(*names):
+    for name in names:
+        version_store.incr(name)
+
+
+def cached_reference(name, loader):
+    """Reference data (routes, stations...) cached per worker and, if enabled,
+    in the shared cache, for one reference-data version."""
+    key = ("ref", name, data_version("ref"))
+    value = _reference_cache.get(key)
+    if value is not None:
+        return value
+
+    raw = shared_cache.get(key) if shared_cache else None
+    if raw is not None:
+        value = json.loads(raw)
+    else:
+        value = loader()
+        if shared_cache:
+            shared_cache.put(key, json.dumps(value, default=str).encode())
+
+    if len(_reference_cache) > 256:
+        _reference_cache.clear()
+    _reference_cache[key] = value
+    return value
+
+
+def page_etag(deps, *extra):
+    parts = [BOOT_ID] + [f"{n}{data_version(n)}" for n in deps] + [str(x) for x in extra]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+
+
+def etag_matches(etag):
+    if request.if_none_match.star_tag:
+        return True
+    for tag in request.if_none_match.as_set(include_weak=True):
+        # Flask-Compress sends the tag out as "<etag>:gzip"
+        if tag.split(":")[0] == etag:
+            return True
+    return False
+
+
+def conditional_get(*deps, extra=None):
+    """Answer If-None-Match with 304 when none of `deps` changed.
+
+    `extra` is an optional callable returning more ETag parts (e.g. today's date).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*a, **kw):
+            parts = [request.full_path] + (list(extra()) if extra else [])
+            etag = page_etag(deps, *parts)
+            if etag_matches(etag):
+                resp = make_response("", 304)
+                resp.set_etag(etag)
+                return resp
+
+            # same page already rendered + compressed for this data version
+            cached = response_cache.lookup(etag)
+            if cached is not None:
+                return cached
+
+            resp = make_response(func(*a, **kw))
+            # safe_db errors come back as JSON with status 200, never tag those
+            if resp.status_code == 200 and resp.mimetype == "text/html":
+                g.page_etag = etag
+                resp.set_etag(etag)
+                resp.headers["Cache-Control"] = "no-cache"
+            return resp
+
+        return wrapper
+
+    return decorator
+
+# ================= RESPONSE CACHE =================
+# Flask-Compress gzips every response again, even the same home page for the
+# same data version. Pages tagged by conditional_get() are compressed here
+# instead and the compressed bytes are kept per (URL, data version, encoding);
+# a hit skips the view, the queries and the compression.
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", 16 * 1024 * 1024))
+COMPRESS_MIN_SIZE = app.config.get("COMPRESS_MIN_SIZE", 500)
+
+
+def compress_body(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+
+class CompressedResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (body, mimetype, compress seconds)
+        self._size = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.skipped_small = 0
+        self.cpu_spent = 0.0
+        self.cpu_saved = 0.0
+
+    @staticmethod
+    def use_shared():
+        # only anonymous GETs go to the cross-worker cache
+        return shared_cache is not None and not session.get("user_logged_in")
+
+    @staticmethod
+    def choose_encoding():
+        accepted = request.accept_encodings
+        if brotli is not None and accepted["br"]:
+            return "br"
+        if accepted["gzip"]:
+            return "gzip"
+        return None
+
+    def get(self, key, shared=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.cpu_saved += entry[2]
+                return entry
+
+        if shared:
+            # another worker may already have compressed this page
+            raw = shared_cache.get(key)
+            if raw is not None:
+                meta, body = raw.split(b"\n", 1)
+                mimetype, seconds = meta.decode().split(" ")
+                entry = (body, mimetype, float(seconds))
+                self.put(key, *entry)
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                    self.cpu_saved += entry[2]
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, body, mimetype, seconds):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = (body, mimetype, seconds)
+            self._size += len(body)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[0])
+
+    def lookup(self, etag):
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return None
+        entry = self.get((request.full_path, etag, encoding), shared=self.use_shared())
+        if entry is None:
+            return None
+        body, mimetype, _ = entry
+        resp = make_response(body)
+        resp.mimetype = mimetype
+        self._tag(resp, etag, encoding)
+        return resp
+
+    def store(self, resp, etag):
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return resp
+        body = resp.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            self.skipped_small += 1
+            return resp
+
+        started = time.process_time()
+        compressed = compress_body(body, encoding)
+        seconds = time.process_time() - started
+        self.cpu_spent += seconds
+        key = (request.full_path, etag, encoding)
+        self.put(key, compressed, resp.mimetype, seconds)
+        if self.use_shared():
+            shared_cache.put(key, f"{resp.mimetype} {seconds:.6f}\n".encode() + compressed)
+
+        resp.set_data(compressed)
+        self._tag(resp, etag, encoding)
+        return resp
+
+    @staticmethod
+    def _tag(resp, etag, encoding):
+        # Flask-Compress leaves responses that already carry Content-Encoding alone
+        resp.headers["Content-Encoding"] = encoding
+        resp.headers["Vary"] = "Accept-Encoding"
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.set_etag(f"{etag}:{encoding}")
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "skipped_small": self.skipped_small,
+            "cpu_spent_ms": round(self.cpu_spent * 1000, 2),
+            "cpu_saved_ms": round(self.cpu_saved * 1000, 2),
+        }
+
+
+response_cache = CompressedResponseCache(RESPONSE_CACHE_BYTES)
+
+
+@app.after_request
+def compress_cacheable_pages(resp):
+    # registered after Compress(app), so it runs before Flask-Compress does
+    etag = g.get("page_etag")
+    if (etag is None or request.method != "GET" or resp.status_code != 200
+            or "Content-Encoding" in resp.headers or resp.direct_passthrough):
+        return resp
+    return response_cache.store(resp, etag)
+
+# ================= STATIC ASSETS =================
+# build_static.py writes content-hashed copies (+ .br / .gz) of static/ into
+# static/dist. They are served from /assets with immutable caching, so repeat
+# visitors download nothing and the worker never compresses a static file.
+ASSET_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_DIR, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print("⚠️ static/dist/manifest.json missing, run build_static.py")
+        return {}
+
+
+ASSET_MANIFEST = load_asset_manifest()
+ASSET_FILES = {a["path"]: a["encodings"] for a in ASSET_MANIFEST.values()}
+
+
+def asset_url(filename):
+    asset = ASSET_MANIFEST.get(filename)
+    if asset:
+        return f"/assets/{asset['path']}"
+    return url_for("static", filename=filename)
+
+
+app.jinja_env.globals["asset_url"] = asset_url
+
+
+@app.route("/assets/<path:filename>")
+def assets(filename):
+    if filename not in ASSET_FILES:
+        abort(404)
+
+    accepted = request.accept_encodings
+    encoding = next((e for e in ASSET_FILES[filename] if accepted[e]), None)
+    suffix = {"br": ".br", "gzip": ".gz"}.get(encoding, "")
+
+    resp = send_from_directory(
+        ASSET_DIR, filename + suffix,
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        max_age=ASSET_MAX_AGE,
+    )
+    if encoding:
+        # Flask-Compress leaves responses that already carry Content-Encoding alone
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
 # ================= DB INIT =================
 def init_db():
     try:
@@ -171,6 +693,69 @@ def init_db():
             lng DOUBLE PRECISION DEFAULT 75.2
         )""")
 
+        # Live positions change every few seconds; keeping them out of the
+        # read-mostly schedules table avoids constant MVCC churn there.
+        # UNLOGGED (a crash only loses the last positions) and a low fillfactor
+        # with no index on the updated columns keep the upserts HOT.
+        cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS bus_positions (
+            schedule_id INT PRIMARY KEY,
+            lat DOUBLE PRECISION,
+            lng DOUBLE PRECISION,
+            speed REAL DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        ) WITH (fillfactor = 50)""")
+
+        # GPS history: append-only, one partition per day, compact integers
+        # (lat/lng in 1e-6 degrees, speed in 0.1 km/h). Raw rows are kept for
+        # TRACK_RAW_HOURS, then TrackCompactor folds them into the coarser
+        # 1-minute and 10-minute tiers and drops the day's partition.
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS gps_tracks (
+            schedule_id INT NOT NULL,
+            ts TIMESTAMPTZ NOT NULL,
+            lat_e6 INT NOT NULL,
+            lng_e6 INT NOT NULL,
+            speed_dkmh SMALLINT NOT NULL DEFAULT 0
+        ) PARTITION BY RANGE (ts)""")
+        cur.execute("CREATE INDEX IF NOT EXISTS gps_tracks_sid_ts ON gps_tracks (schedule_id, ts)")
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS station_events (
+            id BIGSERIAL PRIMARY KEY,
+            schedule_id INT NOT NULL,
+            route_id INT NOT NULL,
+            station_name VARCHAR(50),
+            station_index INT,
+            event VARCHAR(10) NOT NULL,
+            ts TIMESTAMPTZ NOT NULL
+        )""")
+        cur.execute("CREATE INDEX IF NOT EXISTS station_events_sid_ts ON station_events (schedule_id, ts)")
+
+        for tier in ("gps_tracks_1m", "gps_tracks_10m"):
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {tier} (
+                schedule_id INT NOT NULL,
+                ts TIMESTAMPTZ NOT NULL,
+                lat_e6 INT NOT NULL,
+                lng_e6 INT NOT NULL,
+                speed_dkmh SMALLINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (schedule_id, ts)
+            )""")
+
+        # hardware GPS trackers (tracker_server.py) -> the schedule they report for
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS tracker_devices (
+            device_id VARCHAR(32) PRIMARY KEY,
+            schedule_id INT NOT NULL REFERENCES schedules(id) ON DELETE CASCADE
+        )""")
+
+        cur.execute("""
+        INSERT INTO bus_positions (schedule_id, lat, lng)
+        SELECT id, current_lat, current_lng FROM schedules
+        WHERE current_lat IS NOT NULL
+        ON CONFLICT DO NOTHING""")
+
         conn.commit()
 
         # ===== DEFAULT DATA =====
@@ -254,38 +839,1535 @@ print("✅ Connection pool ready")
 init_db()
 
 
+# ================= SHARED POSITIONS =================
+# A driver's socket lands on one gunicorn worker while passengers may hit any
+# other. With POSITION_SHM_PATH set (or SHARED_CACHE_DIR), the latest fix per
+# bus lives in a fixed-layout mmap'ed table that every worker on the host
+# reads directly, without locks or DB queries.
+#
+#   header: magic(8) slots used(4) capacity(4) writes(8)
+#   slot:   seq(4) sid(4) lat(8) lng(8) speed(8) ts(8)
+#
+# Writers take a thread lock plus an flock (which only excludes other
+# processes) and bump the slot's seq to odd before writing and back to even
+# after; readers retry until they see the same even seq on both sides of the
+# copy (a seqlock), and give up on a slot that stays odd, e.g. because its
+# writer died mid-write. Slots are claimed in order, so a snapshot scans only
+# the `used` prefix.
+POSITION_SHM_PATH = os.getenv("POSITION_SHM_PATH") or (
+    os.path.join(SHARED_CACHE_DIR, "positions.bin") if SHARED_CACHE_DIR else None)
+POSITION_SHM_SLOTS = int(os.getenv("POSITION_SHM_SLOTS", 4096))
+
+
+class SharedPositionTable:
+    MAGIC = b"MYBUSPOS"
+    HEADER = struct.Struct("<8sIIQ")
+    SLOT = struct.Struct("<Iidddd")
+    SEQ = struct.Struct("<I")
+    READ_RETRIES = 1000
+
+    def __init__(self, path, capacity):
+        size = self.HEADER.size + self.SLOT.size * capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != size or os.pread(fd, 8, 0) != self.MAGIC:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, self.HEADER.pack(self.MAGIC, 0, capacity, 0), 0)
+            self._fd = fd
+            self._map = mmap.mmap(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.capacity = capacity
+        self._index = {}  # sid -> slot, local cache of the claimed prefix
+        self._lock = threading.Lock()
+
+    def _offset(self, slot):
+        return self.HEADER.size + self.SLOT.size * slot
+
+    def _used(self):
+        return struct.unpack_from("<I", self._map, 8)[0]
+
+    def writes(self):
+        return struct.unpack_from("<Q", self._map, 16)[0]
+
+    def _slot_of(self, sid):
+        slot = self._index.get(sid)
+        if slot is None:
+            # another worker may have claimed it since we last looked
+            for i in range(len(self._index), self._used()):
+                self._index[struct.unpack_from("<i", self._map, self._offset(i) + 4)[0]] = i
+            slot = self._index.get(sid)
+        return slot
+
+    def write(self, sid, lat, lng, speed, ts):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                slot = self._slot_of(sid)
+                if slot is None:
+                    slot = self._used()
+                    if slot >= self.capacity:
+                        return False
+                    struct.pack_into("<i", self._map, self._offset(slot) + 4, sid)
+                    struct.pack_into("<I", self._map, 8, slot + 1)
+                    self._index[sid] = slot
+
+                off = self._offset(slot)
+                seq = self.SEQ.unpack_from(self._map, off)[0] | 1  # odd, even if a dead writer left it odd
+                self.SEQ.pack_into(self._map, off, seq)
+                self.SLOT.pack_into(self._map, off, seq, sid, lat, lng, speed, ts)
+                self.SEQ.pack_into(self._map, off, seq + 1)
+                struct.pack_into("<Q", self._map, 16, self.writes() + 1)
+                return True
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read_slot(self, slot):
+        off = self._offset(slot)
+        for _ in range(self.READ_RETRIES):
+            seq, sid, lat, lng, speed, ts = self.SLOT.unpack_from(self._map, off)
+            if not seq & 1 and self.SEQ.unpack_from(self._map, off)[0] == seq:
+                break
+        else:
+            return None  # stuck mid-write, treat as missing until the next write
+        if not seq:
+            return None  # claimed but never written
+        return {"sid": sid, "lat": lat, "lng": lng, "speed": speed, "last_seen": ts}
+
+    def read(self, sid):
+        slot = self._slot_of(sid)
+        return None if slot is None else self._read_slot(slot)
+
+    def snapshot(self):
+        buses = (self._read_slot(i) for i in range(self._used()))
+        return sorted((b for b in buses if b), key=lambda b: b["sid"])
+
+# ================= LIVE BUSES =================
+# Buses that are actually moving, fed by driver_gps. The home page and
+# /api/live-buses read from here instead of joining schedules on every hit;
+# a bus drops out once it hasn't reported for LIVE_BUS_TTL seconds.
+LIVE_BUS_TTL = int(os.getenv("LIVE_BUS_TTL", 120))
+
+
+def load_schedule_meta():
+    conn, cur = get_db()
+    cur.execute("""
+        SELECT s.id, s.bus_name, s.route_id, r.route_name
+        FROM schedules s JOIN routes r ON s.route_id = r.id
+        ORDER BY s.id
+    """)
+    return cur.fetchall()
+
+
+_schedule_meta = {}
+
+
+def schedule_meta():
+    """{sid: schedule row} for the current reference data (rebuilt once per version)."""
+    key = data_version("ref")
+    meta = _schedule_meta.get(key)
+    if meta is None:
+        meta = {s["id"]: s for s in cached_reference("schedules", load_schedule_meta)}
+        _schedule_meta.clear()
+        _schedule_meta[key] = meta
+    return meta
+
+
+def known_sid(sid):
+    """GPS is only taken for buses with a schedule row (anything else can never be stored).
+
+    Schedule ids are positive; the wire format relies on that.
+    """
+    return sid > 0 and sid in schedule_meta()
+
+
+class LiveBusStore:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._buses = {}  # sid -> latest fix
+
+    def update(self, sid, lat, lng, speed):
+        with self._lock:
+            self._buses[sid] = {"sid": sid, "lat": lat, "lng": lng, "speed": speed, "last_seen": time.time()}
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for sid in [sid for sid, b in self._buses.items() if b["last_seen"] < cutoff]:
+            del self._buses[sid]
+
+    def get(self, sid):
+        with self._lock:
+            self._evict()
+            bus = self._buses.get(sid)
+            return dict(bus) if bus else None
+
+    def active(self):
+        with self._lock:
+            self._evict()
+            return sorted((dict(b) for b in self._buses.values()), key=lambda b: b["sid"])
+
+
+class SharedLiveBusStore:
+    """LiveBusStore API on top of the cross-worker SharedPositionTable."""
+
+    def __init__(self, table, ttl):
+        self.table = table
+        self.ttl = ttl
+
+    def update(self, sid, lat, lng, speed):
+        self.table.write(sid, lat, lng, speed, time.time())
+
+    def _fresh(self, bus):
+        return bus is not None and bus["last_seen"] >= time.time() - self.ttl
+
+    def get(self, sid):
+        bus = self.table.read(sid)
+        return bus if self._fresh(bus) else None
+
+    def active(self):
+        return [b for b in self.table.snapshot() if self._fresh(b)]
+
+
+if POSITION_SHM_PATH:
+    live_buses = SharedLiveBusStore(SharedPositionTable(POSITION_SHM_PATH, POSITION_SHM_SLOTS), LIVE_BUS_TTL)
+    print(f"✅ Shared position table at {POSITION_SHM_PATH}")
+else:
+    live_buses = LiveBusStore(LIVE_BUS_TTL)
+
+
+def live_bus_list():
+    meta = schedule_meta()
+    now = time.time()
+    out = []
+    for bus in live_buses.active():
+        info = meta.get(bus["sid"])
+        if info is None:
+            continue
+        bus.update(bus_name=info["bus_name"], route_id=info["route_id"],
+                   route_name=info["route_name"], age_s=round(now - bus["last_seen"], 1))
+        out.append(bus)
+    return out
+
+
+@app.route("/api/live-buses")
+@safe_db
+def api_live_buses():
+    return jsonify({"ok": True, "buses": live_bus_list()})
+
+
+@app.route("/api/live-bus/<int:sid>")
+@safe_db
+def api_live_bus(sid):
+    bus = live_buses.get(sid)
+    if not bus:
+        return jsonify({"ok": False, "error": "Bus not live"}), 404
+    return jsonify({"ok": True, "bus": bus})
+
+# ================= TRACK HISTORY =================
+TRACK_RAW_HOURS = int(os.getenv("TRACK_RAW_HOURS", 24))
+TRACK_1M_DAYS = int(os.getenv("TRACK_1M_DAYS", 30))
+TRACK_10M_DAYS = int(os.getenv("TRACK_10M_DAYS", 365))
+TRACK_COMPACT_INTERVAL = int(os.getenv("TRACK_COMPACT_INTERVAL", 3600))
+
+_track_partitions = set()
+
+
+def track_partition(day):
+    return f"gps_tracks_p{day:%Y%m%d}"
+
+
+def ensure_track_partition(conn, day):
+    # rows are routed by their UTC date, so the bounds are UTC whatever the session TimeZone
+    if day in _track_partitions:
+        return
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {track_partition(day)} PARTITION OF gps_tracks
+        FOR VALUES FROM ('{day} 00:00+00') TO ('{day + timedelta(days=1)} 00:00+00')
+    """)
+    _track_partitions.add(day)
+
+
+def write_track_rows(conn, track):
+    """Bulk-append (sid, unix ts, lat, lng, speed) fixes to gps_tracks."""
+    if not track:
+        return
+    rows = []
+    for sid, ts, lat, lng, speed in track:
+        when = datetime.fromtimestamp(ts, timezone.utc)
+        rows.append((sid, when, round(lat * 1e6), round(lng * 1e6), min(round(speed * 10), 32767)))
+    for day in {r[1].date() for r in rows}:
+        ensure_track_partition(conn, day)
+    with conn.cursor() as cur:
+        with cur.copy("COPY gps_tracks (schedule_id, ts, lat_e6, lng_e6, speed_dkmh) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+
+
+class TrackCompactor:
+    """Hourly job: raw day partitions -> 1-minute tier -> 10-minute tier -> gone.
+
+    Keeping one fix per bus per bucket (the last one) bounds storage to
+    roughly fleet x (1440 per day for 30 days + 144 per day for a year).
+    A Postgres advisory lock makes sure only one worker compacts at a time.
+    """
+    LOCK_KEY = 42_0037
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._started = False
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.partitions_dropped = 0
+        self.last_run_ms = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="track-compactor", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.compact()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            time.sleep(self.interval)
+
+    def compact(self):
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        with pool.connection() as conn:
+            if not conn.execute("SELECT pg_try_advisory_lock(%s)", (self.LOCK_KEY,)).fetchone()[0]:
+                return
+            conn.commit()
+            try:
+                self._compact_raw(conn, now - timedelta(hours=TRACK_RAW_HOURS))
+                self._downsample(conn, "gps_tracks_1m", "gps_tracks_10m", 600, now - timedelta(days=TRACK_1M_DAYS))
+                conn.execute("DELETE FROM gps_tracks_10m WHERE ts < %s", (now - timedelta(days=TRACK_10M_DAYS),))
+                conn.commit()
+            finally:
+                conn.rollback()
+                conn.execute("SELECT pg_advisory_unlock(%s)", (self.LOCK_KEY,))
+                conn.commit()
+        self.runs += 1
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+
+    def _compact_raw(self, conn, cutoff):
+        parts = conn.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = 'gps_tracks'
+        """).fetchall()
+        for (name,) in sorted(parts):
+            try:
+                day = datetime.strptime(name[-8:], "%Y%m%d").date()
+            except ValueError:
+                continue
+            if datetime.combine(day + timedelta(days=1), datetime.min.time(), timezone.utc) > cutoff:
+                continue
+            conn.execute(f"""
+                INSERT INTO gps_tracks_1m (schedule_id, ts, lat_e6, lng_e6, speed_dkmh)
+                SELECT DISTINCT ON (schedule_id, date_trunc('minute', ts))
+                       schedule_id, date_trunc('minute', ts), lat_e6, lng_e6, speed_dkmh
+                FROM {name}
+                ORDER BY schedule_id, date_trunc('minute', ts), ts DESC
+                ON CONFLICT DO NOTHING
+            """)
+            conn.execute(f"DROP TABLE {name}")
+            conn.commit()
+            _track_partitions.discard(day)
+            self.partitions_dropped += 1
+
+    def _downsample(self, conn, src, dst, seconds, cutoff):
+        conn.execute(f"""
+            INSERT INTO {dst} (schedule_id, ts, lat_e6, lng_e6, speed_dkmh)
+            SELECT DISTINCT ON (schedule_id, bucket)
+                   schedule_id, bucket, lat_e6, lng_e6, speed_dkmh
+            FROM (
+                SELECT *, to_timestamp(floor(extract(epoch FROM ts) / {seconds}) * {seconds}) AS bucket
+                FROM {src} WHERE ts < %s
+            ) t
+            ORDER BY schedule_id, bucket, ts DESC
+            ON CONFLICT DO NOTHING
+        """, (cutoff,))
+        conn.execute(f"DELETE FROM {src} WHERE ts < %s", (cutoff,))
+
+    def stats(self):
+        return {"runs": self.runs, "partitions_dropped": self.partitions_dropped,
+                "last_run_ms": round(self.last_run_ms, 2)}
+
+
+track_compactor = TrackCompactor(TRACK_COMPACT_INTERVAL)
+
+# ================= GPS WRITE-BEHIND =================
+# A phone's watchPosition can fire every second; committing each fix means
+# hundreds of commits per second nobody needs. Fixes are buffered here, only
+# the latest per sid is kept, and the buffer is upserted into bus_positions in
+# one statement every GPS_FLUSH_INTERVAL seconds (and once more on shutdown).
+# Every fix is also appended to gps_tracks with one COPY per flush. If the DB
+# is unreachable the flush is kept for the next one; any other failure means a
+# bad row, and the flush is redone row by row so only that row is lost.
+GPS_FLUSH_INTERVAL = float(os.getenv("GPS_FLUSH_INTERVAL", 5))
+TRACK_BUFFER_MAX = int(os.getenv("TRACK_BUFFER_MAX", 200000))
+
+
+class GpsWriteBehind:
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}  # sid -> (lat, lng, speed, unix time)
+        self._track = []  # every fix, for gps_tracks
+        self._events = []  # station arrival / departure events
+        self._stop = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.written = 0
+        self.track_rows = 0
+        self.track_dropped = 0
+        self.flushes = 0
+        self.errors = 0
+        self.dead_lettered = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def add(self, sid, lat, lng, speed=0.0, ts=None):
+        ts = ts or time.time()
+        with self._lock:
+            self._pending[sid] = (lat, lng, speed, ts)
+            self._track.append((sid, ts, lat, lng, speed))
+            self.received += 1
+            if self._thread is None:
+                # started lazily so it lives in the gunicorn worker, not the master
+                self._thread = threading.Thread(target=self._run, name="gps-write-behind", daemon=True)
+                self._thread.start()
+                track_compactor.start()
+
+    def add_event(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            track, self._track = self._track, []
+            events, self._events = self._events, []
+        if not (batch or track or events):
+            return 0
+
+        sids = list(batch)
+        started = time.perf_counter()
+        try:
+            with pool.connection() as conn:
+                self._write(conn, batch, track, events)
+        except psycopg.OperationalError:
+            # DB unreachable: keep everything for the next flush
+            import traceback
+            traceback.print_exc()
+            _track_partitions.clear()
+            self._requeue(batch, track, events)
+            return 0
+        except Exception:
+            # a bad row (bad value for its column, or one that can't even be
+            # converted) fails the whole batch; retrying it as is would block
+            # every later flush, so write row by row and drop the bad ones
+            _track_partitions.clear()  # creations in the failed transaction were rolled back
+            if not self._write_each(batch, track, events):
+                return 0
+
+        # /buses/<rid> shows LIVE from bus_positions, so only re-render once it is written
+        online = [sid for sid in sids if sid not in _gps_seen]
+        if online:
+            _gps_seen.update(online)
+            bump_version("gps_online")
+
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.flushes += 1
+            self.written += len(batch)
+            self.track_rows += len(track)
+            self.last_flush_ms = elapsed
+            self.total_flush_ms += elapsed
+        return len(batch)
+
+    def _requeue(self, batch, track, events):
+        with self._lock:
+            self.errors += 1
+            for sid, pos in batch.items():
+                self._pending.setdefault(sid, pos)  # newer fixes win
+            self._track[:0] = track
+            self._events[:0] = events
+            overflow = len(self._track) - TRACK_BUFFER_MAX
+            if overflow > 0:
+                del self._track[:overflow]  # DB down for long: drop the oldest
+                self.track_dropped += overflow
+
+    def _write(self, conn, batch, track, events):
+        if batch:
+            sids = list(batch)
+            rows = [batch[k] for k in sids]
+            conn.execute("""
+                INSERT INTO bus_positions (schedule_id, lat, lng, speed, updated_at)
+                SELECT v.id, v.lat, v.lng, v.speed, to_timestamp(v.ts)
+                FROM unnest(%s::int[], %s::float8[], %s::float8[], %s::real[], %s::float8[])
+                     AS v(id, lat, lng, speed, ts)
+                ON CONFLICT (schedule_id) DO UPDATE
+                SET lat = EXCLUDED.lat, lng = EXCLUDED.lng,
+                    speed = EXCLUDED.speed, updated_at = EXCLUDED.updated_at
+            """, (sids, [r[0] for r in rows], [r[1] for r in rows],
+                  [r[2] for r in rows], [r[3] for r in rows]))
+        write_track_rows(conn, track)
+        if events:
+            with conn.cursor() as cur:
+                cur.executemany("""
+                    INSERT INTO station_events
+                    (schedule_id, route_id, station_name, station_index, event, ts)
+                    VALUES (%(sid)s, %(route_id)s, %(station)s, %(index)s, %(event)s, to_timestamp(%(t)s))
+                """, events)
+
+    def _write_each(self, batch, track, events):
+        """One transaction per row; bad rows are dropped. False if the DB went away."""
+        parts = ([({sid: pos}, [], []) for sid, pos in batch.items()]
+                 + [({}, [row], []) for row in track]
+                 + [({}, [], [event]) for event in events])
+        done = 0
+        try:
+            with pool.connection() as conn:
+                for part in parts:
+                    try:
+                        with conn.transaction():
+                            self._write(conn, *part)
+                    except psycopg.OperationalError:
+                        raise
+                    except Exception as e:
+                        _track_partitions.clear()
+                        with self._lock:
+                            self.dead_lettered += 1
+                        print(f"⚠️ GPS write-behind dropped {part}: {e!r}")
+                    done += 1
+        except psycopg.OperationalError:
+            import traceback
+            traceback.print_exc()
+            _track_partitions.clear()
+            rest = parts[done:]
+            self._requeue({sid: pos for p in rest for sid, pos in p[0].items()},
+                          [row for p in rest for row in p[1]], [e for p in rest for e in p[2]])
+            return False
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def stats(self):
+        return {
+            "interval_s": self.interval,
+            "received": self.received,
+            "written": self.written,
+            "pending": len(self._pending),
+            "coalescing_ratio": round(self.received / self.written, 2) if self.written else None,
+            "track_rows": self.track_rows,
+            "track_pending": len(self._track),
+            "track_dropped": self.track_dropped,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "dead_lettered": self.dead_lettered,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else None,
+        }
+
+
+gps_writer = GpsWriteBehind(GPS_FLUSH_INTERVAL)
+# registered after shutdown_pool, so atexit runs it first while the pool is open
+atexit.register(gps_writer.stop)
+
+
+def ingest_fix(sid, lat, lng, speed, fix_time=None, accuracy=None):
+    """Position pipeline shared by every GPS source.
+
+    Returns the (possibly route-snapped) (lat, lng, speed, time) that was
+    stored, or None if the filter rejected the fix; only stored fixes should
+    be fanned out.
+    """
+    return ingest_fixes(sid, [(lat, lng, speed, fix_time or time.time(), accuracy)])
+
+
+def ingest_fixes(sid, fixes, max_age=None):
+    """Run a bus's fixes [(lat, lng, speed, unix time, accuracy)] through the pipeline.
+
+    Every accepted fix is filtered, recorded in the track and checked against
+    the geofences; the live store is only moved to the newest one. Returns that
+    newest stored (lat, lng, speed, time), or None if nothing was accepted.
+    """
+    if not known_sid(sid):
+        return None
+    route = route_geometry()[0].get(schedule_meta()[sid]["route_id"])
+    newest = None
+    for lat, lng, speed, t, accuracy in sorted(fixes, key=lambda f: f[3]):
+        fix = gps_filter.apply(sid, route, lat, lng, t, accuracy, max_age or GPS_MAX_AGE_S)
+        if fix is None:
+            continue
+        lat, lng = fix
+        gps_writer.add(sid, lat, lng, speed, t)
+        if route is not None:
+            for event in geofences.check(sid, route, lat, lng, t):
+                gps_writer.add_event(event)
+                socketio.emit("station_event", event, to=[bus_room(sid), route_room(route.route_id)])
+        newest = (lat, lng, speed, t)
+    if newest is None:
+        return None
+
+    live_buses.update(sid, newest[0], newest[1], newest[2])
+    nearby.update_bus(sid, newest[0], newest[1])
+    eta_engine.start()
+    return newest
+
+
+def emit_bus_location(sid, lat, lng, speed, timestamp="", predicted=False):
+    room = bus_room(sid)
+    payload = {"sid": sid, "lat": lat, "lng": lng, "speed": speed, "timestamp": timestamp}
+    if predicted:
+        payload["predicted"] = True
+    socketio.emit("bus_location", payload, to=position_room(room, "json"))
+    socketio.emit("bus_location_bin", encode_text(0, time.time(), [[sid, lat, lng, speed]]),
+                  to=position_room(room, "bin"))
+
+
+def publish_fix(sid, lat, lng, speed, t, timestamp=None):
+    # viewers of this bus get every fix, route pages get it in the next frame
+    emit_bus_location(sid, lat, lng, speed, int(t * 1000) if timestamp is None else timestamp)
+    meta = schedule_meta().get(sid)
+    if meta:
+        route_frames.mark(meta["route_id"], sid, lat, lng, speed)
+        dead_reckoning.fix(sid, meta["route_id"], lat, lng, speed, t)
+
+# ================= ROUTE GEOMETRY =================
+def load_route_stations():
+    conn, cur = get_db()
+    cur.execute("""
+        SELECT route_id, station_name, lat, lng
+        FROM route_stations
+        ORDER BY route_id, station_order
+    """)
+    return cur.fetchall()
+
+
+_route_geometry = {}
+
+
+def route_geometry():
+    """({route_id: RouteGeometry}, FleetGeometry) for the current reference data."""
+    key = data_version("ref")
+    cached = _route_geometry.get(key)
+    if cached is None:
+        stations = {}
+        for r in cached_reference("route_stations", load_route_stations):
+            if r["lat"] is not None and r["lng"] is not None:
+                stations.setdefault(r["route_id"], []).append((r["station_name"], r["lat"], r["lng"]))
+        routes = {rid: RouteGeometry(rid, st) for rid, st in stations.items()}
+        cached = (routes, FleetGeometry(routes.values()))
+        _route_geometry.clear()
+        _route_geometry[key] = cached
+    return cached
+
+# ================= ROUTE SHAPES =================
+# Map pages draw a route from a small JSON asset instead of a station list
+# serialized into every page view. Built once per reference data version:
+#   {"route_id": 1, "stations": [[name, lat, lng], ...],
+#    "levels": [[min_zoom, encoded polyline], ...]}
+# Each level is the polyline Douglas-Peucker-simplified to ROUTE_SHAPE_PX
+# pixels at that zoom (levels identical to the previous one are left out).
+# The URL carries a hash of the content, so browsers cache it for good.
+ROUTE_SHAPE_ZOOMS = (5, 8, 11, 14)
+ROUTE_SHAPE_PX = 2
+EARTH_CIRCUMFERENCE_KM = 40075.017
+
+_route_shapes = {}
+
+
+def build_route_shape(route):
+    levels = []
+    for zoom in ROUTE_SHAPE_ZOOMS:
+        km_per_px = EARTH_CIRCUMFERENCE_KM * math.cos(math.radians(route.lat0)) / (256 * 2 ** zoom)
+        keep = route.simplify(ROUTE_SHAPE_PX * km_per_px)
+        encoded = encode_polyline(zip(route.lat[keep].tolist(), route.lng[keep].tolist()))
+        if not levels or levels[-1][1] != encoded:
+            levels.append([zoom, encoded])
+    stations = [[name, round(float(lat), 5), round(float(lng), 5)]
+                for name, lat, lng in zip(route.names, route.lat, route.lng)]
+    return {"route_id": route.route_id, "stations": stations, "levels": levels}
+
+
+def route_shapes():
+    """{route_id: (content digest, JSON body)} for the current reference data."""
+    key = data_version("ref")
+    shapes = _route_shapes.get(key)
+    if shapes is None:
+        shapes = {}
+        for rid, route in route_geometry()[0].items():
+            body = json.dumps(build_route_shape(route), ensure_ascii=False, separators=(",", ":")).encode()
+            shapes[rid] = (hashlib.sha256(body).hexdigest()[:12], body)
+        _route_shapes.clear()
+        _route_shapes[key] = shapes
+    return shapes
+
+
+def route_shape_url(rid):
+    shape = route_shapes().get(rid)
+    return f"/route-shape/{rid}.{shape[0]}.json" if shape else None
+
+
+@app.route("/route-shape/<int:rid>.<digest>.json")
+@safe_db
+def route_shape(rid, digest):
+    shape = route_shapes().get(rid)
+    if shape is None:
+        return jsonify({"ok": False, "error": "Route has no stations"}), 404
+    if digest != shape[0]:
+        # a page from before the route changed: send it to the current version
+        return redirect(route_shape_url(rid))
+    resp = Response(status=304) if etag_matches(shape[0]) else Response(shape[1], mimetype="application/json")
+    resp.set_etag(shape[0])
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ASSET_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+# ================= GPS FILTER =================
+# gpsfilter.GpsFilter drops fixes that can't be real (not a position, stale,
+# inaccurate, impossibly fast) and snaps the rest onto the route within
+# GPS_SNAP_M. After GPS_RESET_S without an accepted fix the next one is
+# trusted, so a bus is never stuck behind one bad fix.
+GPS_MAX_SPEED_KMH = float(os.getenv("GPS_MAX_SPEED_KMH", 130))
+GPS_MAX_ACCURACY_M = float(os.getenv("GPS_MAX_ACCURACY_M", 250))
+GPS_MAX_AGE_S = float(os.getenv("GPS_MAX_AGE_S", 120))
+GPS_SNAP_KM = float(os.getenv("GPS_SNAP_M", 75)) / 1000
+GPS_RESET_S = float(os.getenv("GPS_RESET_S", 180))
+
+gps_filter = GpsFilter(GPS_MAX_SPEED_KMH, GPS_MAX_ACCURACY_M, GPS_MAX_AGE_S, GPS_SNAP_KM, GPS_RESET_S)
+
+# ================= GEOFENCES =================
+# Arrival / departure at route_stations. Each bus only tests the station it
+# is inside (for departure) or the next one or two (for arrival), so a fix
+# costs a couple of float operations however long the route is. The full
+# polyline is searched once, on a bus's first fix, to find where it is.
+GEOFENCE_RADIUS_KM = float(os.getenv("GEOFENCE_RADIUS_M", 300)) / 1000
+GEOFENCE_EXIT_FACTOR = 1.3  # leave a little further out than we enter, no flapping
+
+
+class StationGeofence:
+    def __init__(self, radius_km):
+        self.radius = radius_km
+        self._lock = threading.Lock()
+        self._state = {}  # sid -> [route_id, next station index, station index inside or None]
+        self.arrivals = 0
+        self.departures = 0
+
+    def _locate(self, route, lat, lng):
+        loc = route.locate(lat, lng)
+        if loc is None:
+            return [route.route_id, 0, None]  # single station: only watch for arriving there
+        along, seg, _ = loc
+        for j in (seg, seg + 1):
+            if route.station_distance_km(j, lat, lng) <= self.radius:
+                return [route.route_id, j + 1, j]
+        nxt = int(np.searchsorted(route.cum, along, side="right"))
+        return [route.route_id, nxt, None]
+
+    def _event(self, sid, route, j, kind, t):
+        return {"sid": sid, "route_id": route.route_id, "station": route.names[j],
+                "index": j, "event": kind, "t": t or time.time()}
+
+    def check(self, sid, route, lat, lng, t=None):
+        with self._lock:
+            state = self._state.get(sid)
+            if state is None or state[0] != route.route_id:
+                self._state[sid] = self._locate(route, lat, lng)
+                return []
+
+            events = []
+            _, nxt, inside = state
+            if inside is not None:
+                if route.station_distance_km(inside, lat, lng) > self.radius * GEOFENCE_EXIT_FACTOR:
+                    events.append(self._event(sid, route, inside, "departure", t))
+                    state[2] = None
+                    self.departures += 1
+            else:
+                for j in (nxt, nxt + 1):
+                    if j < len(route.names) and route.station_distance_km(j, lat, lng) <= self.radius:
+                        events.append(self._event(sid, route, j, "arrival", t))
+                        state[1], state[2] = j + 1, j
+                        self.arrivals += 1
+                        break
+            return events
+
+    def stats(self):
+        return {"radius_m": round(self.radius * 1000), "buses": len(self._state),
+                "arrivals": self.arrivals, "departures": self.departures}
+
+
+geofences = StationGeofence(GEOFENCE_RADIUS_KM)
+
+# ================= NEARBY =================
+# "Buses near me" and "nearest station" queries. Live buses and stations sit
+# in geo.GridIndex grids: ingest_fix() moves a bus between cells as it
+# reports, stations are indexed once per reference data version, and a query
+# only scans the cells around the point instead of every bus or station.
+NEARBY_CELL_DEG = float(os.getenv("NEARBY_CELL_DEG", 0.05))  # ~5 km cells
+NEARBY_MAX_KM = 100
+NEARBY_MAX_K = 50
+NEARBY_MAX_LAT = 85  # grid cells shrink to nothing towards the poles
+
+
+class NearbyIndex:
+    def __init__(self, cell_deg, ttl):
+        self.cell = cell_deg
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._buses = GridIndex(cell_deg)
+        self._seen = {}  # sid -> last fix time
+        self._pruned = 0.0
+        self._synced = None  # SharedPositionTable write count at last sync
+        self._stations = {}  # ref version -> (GridIndex, {name: station})
+        self.queries = 0
+        self.query_us = 0.0
+
+    def update_bus(self, sid, lat, lng):
+        with self._lock:
+            self._buses.update(sid, lat, lng)
+            self._seen[sid] = time.time()
+
+    def _prune(self, now):
+        if now - self._pruned < 1:
+            return
+        self._pruned = now
+        cutoff = now - self.ttl
+        for sid in [sid for sid, t in self._seen.items() if t < cutoff]:
+            self._buses.remove(sid)
+            del self._seen[sid]
+
+    def _sync_shared(self):
+        # fixes taken by other workers only reach us through the shared table
+        writes = live_buses.table.writes()
+        if writes == self._synced:
+            return
+        self._synced = writes
+        for bus in live_buses.table.snapshot():
+            if self._seen.get(bus["sid"], 0) < bus["last_seen"]:
+                self._buses.update(bus["sid"], bus["lat"], bus["lng"])
+                self._seen[bus["sid"]] = bus["last_seen"]
+
+    def _timed(self, started):
+        self.queries += 1
+        self.query_us += (time.perf_counter() - started) * 1e6
+
+    def buses(self, lat, lng, km, k=None):
+        started = time.perf_counter()
+        with self._lock:
+            if isinstance(live_buses, SharedLiveBusStore):
+                self._sync_shared()
+            self._prune(time.time())
+            index = self._buses.copy()
+        # query the snapshot so GPS updates don't queue up behind a slow search
+        found = index.nearest(lat, lng, k, km) if k else index.radius(lat, lng, km)
+        self._timed(started)
+        return found
+
+    def _station_index(self):
+        key = data_version("ref")
+        cached = self._stations.get(key)
+        if cached is None:
+            index, stations = GridIndex(self.cell), {}
+            for r in cached_reference("route_stations", load_route_stations):
+                if r["lat"] is None or r["lng"] is None:
+                    continue
+                st = stations.setdefault(r["station_name"], {
+                    "station": r["station_name"], "lat": r["lat"], "lng": r["lng"], "route_ids": []})
+                st["route_ids"].append(r["route_id"])
+                index.update(r["station_name"], r["lat"], r["lng"])
+            cached = (index, stations)
+            self._stations.clear()
+            self._stations[key] = cached
+        return cached
+
+    def stations(self, lat, lng, km, k=None):
+        index, stations = self._station_index()
+        started = time.perf_counter()
+        found = index.nearest(lat, lng, k, km) if k else index.radius(lat, lng, km)
+        self._timed(started)
+        return [dict(stations[name], distance_km=round(d, 3)) for d, name, _, _ in found]
+
+    def stats(self):
+        return {"buses": len(self._buses), "cell_deg": self.cell, "queries": self.queries,
+                "avg_query_us": round(self.query_us / self.queries, 1) if self.queries else 0.0}
+
+
+nearby = NearbyIndex(NEARBY_CELL_DEG, LIVE_BUS_TTL)
+
+
+def nearby_args():
+    """(lat, lng, km, k) from the query string, k None for a radius query; None if invalid."""
+    try:
+        lat = float(request.args["lat"])
+        lng = float(request.args["lng"])
+        k = request.args.get("k")
+        k = min(int(k), NEARBY_MAX_K) if k else None
+        # k-nearest searches as far as allowed unless told otherwise
+        km = min(float(request.args.get("km", NEARBY_MAX_KM if k else 5)), NEARBY_MAX_KM)
+    except (KeyError, ValueError):
+        return None
+    if not (abs(lat) <= NEARBY_MAX_LAT and -180 <= lng <= 180) or not km > 0 or (k is not None and k < 1):
+        return None
+    return lat, lng, km, k
+
+
+@app.route("/api/near/buses")
+@safe_db
+def api_near_buses():
+    args = nearby_args()
+    if args is None:
+        return jsonify({"ok": False, "error": f"lat (within ±{NEARBY_MAX_LAT}) and lng required, km > 0, k >= 1"}), 400
+    lat, lng, km, k = args
+    meta = schedule_meta()
+    out = []
+    for d, sid, blat, blng in nearby.buses(lat, lng, km, k):
+        info = meta.get(sid)
+        if info is None:
+            continue
+        out.append({"sid": sid, "lat": blat, "lng": blng, "distance_km": round(d, 3),
+                    "bus_name": info["bus_name"], "route_id": info["route_id"],
+                    "route_name": info["route_name"]})
+    return jsonify({"ok": True, "buses": out})
+
+
+@app.route("/api/near/stations")
+@safe_db
+def api_near_stations():
+    args = nearby_args()
+    if args is None:
+        return jsonify({"ok": False, "error": f"lat (within ±{NEARBY_MAX_LAT}) and lng required, km > 0, k >= 1"}), 400
+    lat, lng, km, k = args
+    return jsonify({"ok": True, "stations": nearby.stations(lat, lng, km, k)})
+
+# ================= ETA ENGINE =================
+# Every ETA_TICK seconds the latest fix of every live bus is projected onto
+# its route's station polyline in one NumPy pass (geo.project_fleet), and the
+# remaining distance to every downstream station is turned into an ETA from
+# the bus's recent speed. Results go to the bus's room as bus_eta.
+# Each worker runs its own engine (its sockets only hear its own emits),
+# started by whatever it sees first: a fix, a bus viewer or an ETA request.
+ETA_TICK = float(os.getenv("ETA_TICK", 10))
+ETA_DEFAULT_SPEED = float(os.getenv("ETA_DEFAULT_SPEED", 40))  # km/h, until we've seen it move
+ETA_MIN_SPEED = float(os.getenv("ETA_MIN_SPEED", 5))
+ETA_MAX_SPEED = float(os.getenv("ETA_MAX_SPEED", 120))
+ETA_SPEED_SMOOTHING = 0.3
+
+
+class EtaEngine:
+    def __init__(self, tick):
+        self.tick_seconds = tick
+        self._started = False
+        self._lock = threading.Lock()
+        self._progress = {}  # sid -> (along_km, unix time, smoothed speed km/h)
+        self.latest = {}  # sid -> last bus_eta payload
+        self.ticks = 0
+        self.last_buses = 0
+        self.last_tick_ms = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick_seconds)
+            try:
+                with app.app_context():
+                    self.tick()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def _speeds(self, sids, along, reported, seen):
+        """Smoothed km/h per bus: phone speed if it sends one, else progress along the route."""
+        prev = [self._progress.get(sid) for sid in sids]
+        prev_along = np.array([p[0] if p else np.nan for p in prev])
+        prev_t = np.array([p[1] if p else np.nan for p in prev])
+        prev_v = np.array([p[2] if p else np.nan for p in prev])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            moved = (along - prev_along) / ((seen - prev_t) / 3600)
+        observed = np.where(reported > 1, reported, moved)
+        observed = np.where(np.isfinite(observed) & (observed >= 0) & (seen > prev_t),
+                            np.minimum(observed, ETA_MAX_SPEED), np.nan)
+
+        speed = np.where(np.isnan(prev_v), observed,
+                         np.where(np.isnan(observed), prev_v,
+                                  ETA_SPEED_SMOOTHING * observed + (1 - ETA_SPEED_SMOOTHING) * prev_v))
+        for i, sid in enumerate(sids):
+            self._progress[sid] = (float(along[i]), float(seen[i]), float(speed[i]))
+        return np.where(np.isnan(speed), ETA_DEFAULT_SPEED, np.maximum(speed, ETA_MIN_SPEED))
+
+    def tick(self):
+        started = time.perf_counter()
+        routes, fleet = route_geometry()
+        meta = schedule_meta()
+        buses = [b for b in live_buses.active()
+                 if b["sid"] in meta and meta[b["sid"]]["route_id"] in fleet.row]
+        if not buses:
+            self.last_buses = 0
+            headways.update({})
+            return {}
+
+        sids = [b["sid"] for b in buses]
+        rows = np.array([fleet.row[meta[sid]["route_id"]] for sid in sids])
+        lat = np.array([b["lat"] for b in buses])
+        lng = np.array([b["lng"] for b in buses])
+        along, seg, off_route = project_fleet(fleet, rows, lat, lng)
+        speed = self._speeds(sids, along,
+                             np.array([b["speed"] for b in buses]),
+                             np.array([b["last_seen"] for b in buses]))
+
+        remaining = fleet.station_cum[rows] - along[:, None]  # km to every station
+        with np.errstate(invalid="ignore"):
+            ahead = remaining > 0.05
+        eta_min = remaining / speed[:, None] * 60
+
+        now = time.time()
+        results = {}
+        for i, sid in enumerate(sids):
+            route = fleet.routes[rows[i]]
+            stops = [{"station": route.names[j],
+                      "km": round(float(remaining[i, j]), 1),
+                      "eta_min": round(float(eta_min[i, j]))}
+                     for j in np.flatnonzero(ahead[i])]
+            payload = {"sid": sid, "t": round(now), "speed": round(float(speed[i]), 1),
+                       "along_km": round(float(along[i]), 2),
+                       "off_route_km": round(float(off_route[i]), 2), "stops": stops}
+            results[sid] = payload
+            socketio.emit("bus_eta", payload, to=bus_room(sid))
+
+        self.latest = results
+        headways.update({sid: (meta[sid]["route_id"], float(along[i]), float(speed[i]))
+                         for i, sid in enumerate(sids)})
+        self.ticks += 1
+        self.last_buses = len(sids)
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+        return results
+
+    def stats(self):
+        return {"tick_s": self.tick_seconds, "ticks": self.ticks, "buses": self.last_buses,
+                "last_tick_ms": round(self.last_tick_ms, 2)}
+
+
+eta_engine = EtaEngine(ETA_TICK)
+
+
+@app.route("/api/eta/<int:sid>")
+def api_eta(sid):
+    eta_engine.start()
+    payload = eta_engine.latest.get(sid)
+    if payload is None:
+        return jsonify({"ok": False, "error": "No ETA yet"}), 404
+    return jsonify({"ok": True, **payload})
+
+# ================= HEADWAYS =================
+# After every ETA tick the buses of each route are ordered by how far along
+# the route they are and the gap to the bus in front is turned into a time
+# headway (gap / follower speed). A pair closer than HEADWAY_BUNCH_MIN is
+# bunched: a bunching_alert goes to the admin room, and a cleared one once
+# the gap has opened up again. The order from the previous tick is kept, so
+# re-sorting a route (buses seldom overtake) is close to linear.
+HEADWAY_BUNCH_MIN = float(os.getenv("HEADWAY_BUNCH_MIN", 5))
+HEADWAY_CLEAR_FACTOR = 1.5  # clear a little later than we alert, no flapping
+ADMIN_ROOM = "admin"
+
+
+class HeadwayMonitor:
+    def __init__(self, bunch_min):
+        self.bunch_min = bunch_min
+        self._order = {}  # route_id -> [sid, ...] leader first, from the last tick
+        self._bunched = {}  # (route_id, leader, follower) -> alert payload
+        self.latest = {}  # route_id -> [{leader, follower, gap_km, headway_min}, ...]
+        self.alerts = 0
+        self.last_tick_ms = 0.0
+
+    def _alert(self, event, rid, leader, follower, gap, headway):
+        return {"event": event, "route_id": rid, "leader": leader, "follower": follower,
+                "gap_km": round(gap, 2), "headway_min": round(headway, 1), "t": round(time.time())}
+
+    def update(self, buses):
+        """buses: {sid: (route_id, along-track km, speed km/h)}; returns the alerts raised."""
+        started = time.perf_counter()
+        by_route = {}
+        for sid, (rid, along, speed) in buses.items():
+            by_route.setdefault(rid, {})[sid] = (along, speed)
+
+        latest, pairs, bunched, alerts = {}, {}, {}, []
+        for rid, pos in by_route.items():
+            order = [sid for sid in self._order.get(rid, ()) if sid in pos]
+            known = set(order)
+            order += [sid for sid in pos if sid not in known]
+            order.sort(key=lambda sid: pos[sid][0], reverse=True)  # nearly sorted: Timsort is ~O(n)
+            self._order[rid] = order
+
+            gaps = []
+            for leader, follower in zip(order, order[1:]):
+                gap = pos[leader][0] - pos[follower][0]
+                headway = gap / max(pos[follower][1], ETA_MIN_SPEED) * 60
+                key = (rid, leader, follower)
+                pairs[key] = gap
+                limit = self.bunch_min * (HEADWAY_CLEAR_FACTOR if key in self._bunched else 1)
+                if headway < limit:
+                    bunched[key] = self._bunched.get(key) or self._alert("bunching", *key, gap, headway)
+                    if key not in self._bunched:
+                        alerts.append(bunched[key])
+                gaps.append({"leader": leader, "follower": follower,
+                             "gap_km": round(gap, 2), "headway_min": round(headway, 1)})
+            latest[rid] = gaps
+
+        for key in self._bunched.keys() - bunched.keys():
+            # gap opened up, or another bus now runs between them
+            gap = pairs.get(key)
+            alerts.append({**self._bunched[key], "event": "cleared", "headway_min": None,
+                           "gap_km": round(gap, 2) if gap is not None else None, "t": round(time.time())})
+        for rid in self._order.keys() - by_route.keys():
+            del self._order[rid]
+
+        self._bunched = bunched
+        self.latest = latest
+        for alert in alerts:
+            socketio.emit("bunching_alert", alert, to=ADMIN_ROOM)
+        self.alerts += len(alerts)
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+        return alerts
+
+    def bunched(self):
+        return list(self._bunched.values())
+
+    def stats(self):
+        return {"bunch_min": self.bunch_min, "routes": len(self.latest), "bunched_pairs": len(self._bunched),
+                "alerts": self.alerts, "last_tick_ms": round(self.last_tick_ms, 3)}
+
+
+headways = HeadwayMonitor(HEADWAY_BUNCH_MIN)
+
+
+@app.route("/api/headways")
+@staff_required
+def api_headways():
+    eta_engine.start()
+    return jsonify({"ok": True, "routes": headways.latest,
+                    "bunched": headways.bunched()})
+
+
+@socketio.on("join_admin")
+def on_join_admin(data=None):
+    if not session.get("user_logged_in"):
+        return {"ok": False, "error": "Login required"}
+    join_room(ADMIN_ROOM)
+    eta_engine.start()
+    return {"ok": True}
+
 # ================= SOCKET EVENTS =================
 @socketio.on("connect")
 def handle_connect():
     print(f"✅ Client connected: {request.sid}")
 
 
+def bus_room(sid):
+    return f"bus:{sid}"
+
+
+def route_room(rid):
+    return f"route:{rid}"
+
+
+def _room_id(data, key):
+    try:
+        return int((data or {}).get(key))
+    except (TypeError, ValueError):
+        return None
+
+
+# Position updates go to a sub-room per wire format. A client that sends
+# {"wire": "bin"} with join_bus / join_route gets compact base64 frames
+# (wire.py) as bus_location_bin / bus_frame_bin instead of JSON; everything
+# else (ETAs, station events) stays JSON on the main room.
+WIRE_FORMATS = ("json", "bin")
+
+
+def position_room(room, wire="json"):
+    return f"{room}/{wire}"
+
+
+def _wire(data):
+    return "bin" if (data or {}).get("wire") == "bin" else "json"
+
+
+def _join_positions(room, data):
+    join_room(room)
+    for wire in WIRE_FORMATS:
+        leave_room(position_room(room, wire))
+    join_room(position_room(room, _wire(data)))
+
+
+def _leave_positions(room):
+    leave_room(room)
+    for wire in WIRE_FORMATS:
+        leave_room(position_room(room, wire))
+
+
+@socketio.on("join_bus")
+def on_join_bus(data):
+    sid = _room_id(data, "sid")
+    if sid is not None:
+        _join_positions(bus_room(sid), data)
+        eta_engine.start()  # bus_eta goes to this room
+
+
+@socketio.on("leave_bus")
+def on_leave_bus(data):
+    sid = _room_id(data, "sid")
+    if sid is not None:
+        _leave_positions(bus_room(sid))
+
+
+@socketio.on("join_route")
+def on_join_route(data):
+    rid = _room_id(data, "route_id")
+    if rid is not None:
+        _join_positions(route_room(rid), data)
+
+
+@socketio.on("leave_route")
+def on_leave_route(data):
+    rid = _room_id(data, "route_id")
+    if rid is not None:
+        _leave_positions(route_room(rid))
+
+
+# ================= ROUTE FRAMES =================
+# A route page showing many buses would get one message per fix per bus.
+# Instead the latest position of every bus that moved is collected per route
+# and sent as one compact bus_frame every ROUTE_FRAME_MS:
+#   {"route_id": 1, "t": 1718000000.5, "buses": [[sid, lat, lng, speed], ...]}
+ROUTE_FRAME_MS = int(os.getenv("ROUTE_FRAME_MS", 1000))
+
+
+class RouteFrameEmitter:
+    def __init__(self, interval_ms):
+        self.interval = interval_ms / 1000
+        self._lock = threading.Lock()
+        self._dirty = {}  # route_id -> {sid: [sid, lat, lng, speed]}
+        self._last_sent = {}  # sid -> (lat, lng, speed) of the last frame
+        self._started = False
+        self.frames = 0
+        self.positions = 0
+        self.skipped = 0
+
+    def mark(self, rid, sid, lat, lng, speed):
+        with self._lock:
+            self._dirty.setdefault(rid, {})[sid] = [sid, round(lat, 5), round(lng, 5), round(speed, 1)]
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def tick(self):
+        # buses without a fresh fix this tick move on by dead reckoning
+        now = time.time()
+        for sid, rid, lat, lng, speed in dead_reckoning.predict(now, self.interval):
+            emit_bus_location(sid, lat, lng, speed, int(now * 1000), predicted=True)
+            self.mark(rid, sid, lat, lng, speed)
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+
+        for rid, buses in dirty.items():
+            changed = []
+            for sid, row in buses.items():
+                pos = tuple(row[1:])
+                if self._last_sent.get(sid) == pos:
+                    self.skipped += 1
+                    continue
+                self._last_sent[sid] = pos
+                changed.append(row)
+            if not changed:
+                continue
+            t = time.time()
+            room = route_room(rid)
+            socketio.emit("bus_frame", {"route_id": rid, "t": round(t, 1), "buses": changed},
+                          to=position_room(room, "json"))
+            socketio.emit("bus_frame_bin", encode_text(rid, t, changed), to=position_room(room, "bin"))
+            self.frames += 1
+            self.positions += len(changed)
+
+    def stats(self):
+        return {"interval_ms": int(self.interval * 1000), "frames": self.frames,
+                "positions": self.positions, "skipped_unchanged": self.skipped}
+
+
+route_frames = RouteFrameEmitter(ROUTE_FRAME_MS)
+
+# ================= GPS RATE LIMIT =================
+# A misbehaving phone can send driver_gps many times a second. Each bus gets
+# a token bucket (GPS_RATE_PER_S, bursts up to GPS_BURST); messages beyond it
+# are dropped before they reach the pipeline. A rejected driver_gps_batch is
+# answered with ok: false, so the driver page keeps the fixes and resends
+# them with its next batch. Only buses with a schedule get a bucket, and a
+# bucket idle long enough to have refilled is forgotten (a new one starts
+# full anyway).
+GPS_RATE_PER_S = float(os.getenv("GPS_RATE_PER_S", 1))
+GPS_BURST = float(os.getenv("GPS_BURST", 3))
+
+
+class GpsRateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}  # sid -> [tokens, last refill]
+        self._dropped = {}  # sid -> dropped messages
+        self._swept = time.monotonic()
+        self.accepted = 0
+        self.dropped = 0
+
+    def _sweep(self, now):
+        # once idle for burst / rate a bucket is full again, same as a new one
+        if now - self._swept < 60:
+            return
+        self._swept = now
+        cutoff = now - self.burst / self.rate
+        for sid in [sid for sid, (_, last) in self._buckets.items() if last < cutoff]:
+            del self._buckets[sid]
+
+    def allow(self, sid):
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            bucket = self._buckets.get(sid)
+            if bucket is None:
+                bucket = self._buckets[sid] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.dropped += 1
+                self._dropped[sid] = self._dropped.get(sid, 0) + 1
+                return False
+            bucket[0] -= 1
+            self.accepted += 1
+            return True
+
+    def stats(self):
+        top = sorted(self._dropped.items(), key=lambda d: -d[1])[:10]
+        return {"rate_per_s": self.rate, "burst": self.burst, "accepted": self.accepted,
+                "dropped": self.dropped, "buckets": len(self._buckets), "top_dropped": {str(sid): n for sid, n in top}}
+
+
+gps_limiter = GpsRateLimiter(GPS_RATE_PER_S, GPS_BURST)
+
+# ================= DEAD RECKONING =================
+# Between two accepted fixes a bus keeps moving on screen: every route frame
+# tick, buses whose last fix is older than one tick (but not older than
+# DEAD_RECKON_MAX_S) are advanced along their heading (from their last two
+# fixes) at their last speed. Age is measured from the fix's own time, so a
+# batch of fixes uploaded after a dead zone is shown where it was, not
+# projected forward. Predicted positions go to viewers with "predicted": true
+# and are never stored.
+DEAD_RECKON_MAX_S = float(os.getenv("DEAD_RECKON_MAX_S", 10))
+DEAD_RECKON_MIN_KMH = 3
+DEAD_RECKON_MIN_MOVE_KM = 0.005  # smaller moves are GPS jitter, keep the old heading
+
+
+class DeadReckoner:
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._last = {}  # sid -> [route_id, lat, lng, speed, heading in radians or None, fix time]
+        self.predicted = 0
+
+    def fix(self, sid, rid, lat, lng, speed, t):
+        with self._lock:
+            prev = self._last.get(sid)
+            heading = prev[4] if prev else None
+            if prev and fast_distance_km(prev[1], prev[2], lat, lng) > DEAD_RECKON_MIN_MOVE_KM:
+                heading = math.atan2((lng - prev[2]) * math.cos(math.radians(lat)), lat - prev[1])
+            self._last[sid] = [rid, lat, lng, speed, heading, t]
+
+    def predict(self, now, min_age):
+        """[(sid, route_id, lat, lng, speed)] for every bus due a predicted position."""
+        out = []
+        with self._lock:
+            for sid, (rid, lat, lng, speed, heading, t) in list(self._last.items()):
+                age = now - t
+                if age > LIVE_BUS_TTL:
+                    del self._last[sid]
+                    continue
+                if age < min_age or age > self.max_age or heading is None or speed < DEAD_RECKON_MIN_KMH:
+                    continue
+                km = speed * age / 3600
+                out.append((sid, rid,
+                            round(lat + km * math.cos(heading) / KM_PER_DEG, 6),
+                            round(lng + km * math.sin(heading) / (KM_PER_DEG * math.cos(math.radians(lat))), 6),
+                            speed))
+        self.predicted += len(out)
+        return out
+
+    def stats(self):
+        return {"max_age_s": self.max_age, "tracked": len(self._last), "predicted": self.predicted}
+
+
+dead_reckoning = DeadReckoner(DEAD_RECKON_MAX_S)
+
+
+def fix_time(value):
+    """Phone fix time (ms since epoch from watchPosition) as unix seconds, or None."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(value):
+        return None
+    return value / 1000 if value > 1e11 else value
+
+
 @socketio.on("driver_gps")
 def gps(data):
-    sid = data.get('sid')
-    lat = float(data.get('lat', 27.5))
-    lng = float(data.get('lng', 75.0))
-    speed = float(data.get('speed', 0))
+    try:
+        sid = int(data.get('sid'))
+        lat = float(data.get('lat', 27.5))
+        lng = float(data.get('lng', 75.0))
+        speed = gps_speed(data.get('speed'))
+    except (TypeError, ValueError):
+        return
+    if not known_sid(sid) or not gps_limiter.allow(sid):
+        return
 
     print(f"📍 LIVE: Bus-{sid} @ [{lat:.5f},{lng:.5f}] {speed}km/h")
 
-    # Save to DB
-    try:
-        with app.app_context():
-            conn, cur = get_db()
-            cur.execute("""
-                   UPDATE schedules 
-                   SET current_lat=%s, current_lng=%s
-                   WHERE id=%s
-               """, (lat, lng, sid))
-            conn.commit()
-    except:
-        pass
+    # a live fix is timed by when it got here: phone clocks can be minutes off
+    fix = ingest_fix(sid, lat, lng, speed, None, data.get('accuracy'))
+    if fix is None:
+        return
+    publish_fix(sid, fix[0], fix[1], speed, fix[3], data.get('timestamp', ''))
+
+
+# Drivers on patchy networks buffer fixes and upload them together, over the
+# socket (driver_gps_batch) or plain HTTP when the socket can't connect:
+#   {"sid": 12, "sent_at": ms, "fixes": [{"lat", "lng", "speed", "accuracy", "timestamp"}, ...]}
+# Fix timestamps come from the phone's clock; sent_at (same clock) tells how
+# far off it is, and the whole batch is shifted by that. The batch goes
+# through the pipeline in one pass; only its newest accepted fix is sent to
+# viewers.
+GPS_BATCH_MAX = 500
+GPS_BATCH_MAX_AGE_S = float(os.getenv("GPS_BATCH_MAX_AGE_S", 6 * 3600))
+
+
+def parse_fixes(items, sent_at=None):
+    sent_at = fix_time(sent_at)
+    offset = time.time() - sent_at if sent_at else 0.0
+    fixes = []
+    for item in (items if isinstance(items, list) else [])[-GPS_BATCH_MAX:]:
+        try:
+            lat, lng = float(item["lat"]), float(item["lng"])
+            t = fix_time(item.get("timestamp"))
+        except (TypeError, KeyError, ValueError, AttributeError):
+            continue
+        if not valid_position(lat, lng):
+            continue
+        fixes.append((lat, lng, gps_speed(item.get("speed")), t + offset if t else time.time(),
+                      item.get("accuracy")))
+    return fixes
+
+
+def ingest_batch(sid, items, sent_at=None):
+    fixes = parse_fixes(items, sent_at)
+    newest = ingest_fixes(sid, fixes, GPS_BATCH_MAX_AGE_S) if fixes else None
+    if newest is not None:
+        lat, lng, speed, t = newest
+        publish_fix(sid, lat, lng, speed, t)
+    return {"ok": True, "received": len(fixes), "live": newest is not None}
+
+
+@socketio.on("driver_gps_batch")
+def gps_batch(data):
+    sid = _room_id(data, "sid")
+    if sid is None:
+        return {"ok": False, "error": "sid required"}
+    if not known_sid(sid):
+        return {"ok": False, "error": "Bus not found"}
+    if not gps_limiter.allow(sid):
+        return {"ok": False, "error": "Rate limited"}
+    return ingest_batch(sid, data.get("fixes"), data.get("sent_at"))
+
+
+@app.route("/api/driver/<int:sid>/gps-batch", methods=["POST"])
+@safe_db
+def gps_batch_http(sid):
+    if not known_sid(sid):
+        return jsonify({"ok": False, "error": "Bus not found"}), 404
+    if not gps_limiter.allow(sid):
+        return jsonify({"ok": False, "error": "Rate limited"}), 429
+    data = request.get_json(silent=True) or {}
+    return jsonify(ingest_batch(sid, data.get("fixes"), data.get("sent_at")))
+
+
+# ================= TRACKERS =================
+# tracker_server.py terminates the hardware trackers' TCP/UDP connections and
+# posts what they sent here about once a second, keyed by device id:
+#   {"devices": {"<device_id>": [{"lat", "lng", "speed", "timestamp"}, ...]}}
+# Each device's fixes then take the same path as a driver_gps_batch upload.
+# The request must carry TRACKER_API_KEY in X-Tracker-Key; without a key
+# configured the endpoint refuses everything rather than trusting anyone.
+TRACKER_API_KEY = os.getenv("TRACKER_API_KEY")
+
+
+def load_tracker_devices():
+    conn, cur = get_db()
+    cur.execute("SELECT device_id, schedule_id FROM tracker_devices")
+    return cur.fetchall()
 
-    emit("bus_location", {
-        "sid": sid, "lat": lat, "lng": lng, "speed": speed,
-        "timestamp": data.get('timestamp', '')
-    }, broadcast=True)
+
+@app.route("/api/tracker/fixes", methods=["POST"])
+@safe_db
+def tracker_fixes():
+    if not TRACKER_API_KEY:
+        return jsonify({"ok": False, "error": "Tracker API not configured"}), 503
+    if not hmac.compare_digest(request.headers.get("X-Tracker-Key", ""), TRACKER_API_KEY):
+        return jsonify({"ok": False, "error": "Invalid tracker key"}), 403
+
+    devices = (request.get_json(silent=True) or {}).get("devices") or {}
+    mapping = {d["device_id"]: d["schedule_id"] for d in cached_reference("tracker_devices", load_tracker_devices)}
+    received, unknown = 0, []
+    for device_id, items in devices.items():
+        sid = mapping.get(device_id)
+        if sid is None:
+            unknown.append(device_id)
+            continue
+        received += ingest_batch(sid, items)["received"]
+    return jsonify({"ok": True, "received": received, "unknown": unknown})
 
 
 # ================= HTML BASE =================
@@ -491,14 +2573,18 @@ LOGIN_HTML = """
 </div>
 """
 # ================= ROUTES =================
+def load_routes():
+    conn, cur = get_db()
+    cur.execute("SELECT id, route_name, distance_km FROM routes ORDER BY id")
+    return cur.fetchall()
+
+
 @app.route("/")
+@conditional_get("ref")
 @safe_db
 def home():
-    conn, cur = get_db()
-
     # सभी Routes (बड़े cards)
-    cur.execute("SELECT id, route_name, distance_km FROM routes ORDER BY id")
-    routes = cur.fetchall()
+    routes = cached_reference("routes", load_routes)
 
     # Hero Section
     hero_section = '''
@@ -523,31 +2609,45 @@ def home():
             </div>
         </div>'''
     routes_section += '</div>'
-       # Live GPS Status (नीचे छोटा)
-    cur.execute("""
-        SELECT s.id, s.bus_name, r.route_name, 
-               s.current_lat as lat, s.current_lng as lng
-        FROM schedules s JOIN routes r ON s.route_id = r.id
-        ORDER BY s.id LIMIT 4
-    """)
-    live_buses = cur.fetchall()
-
-    live_section = '<h3 class="text-center mb-4">🟢 Live Running Buses</h3><div class="row g-4">'
-    for bus in live_buses:
-        status = "🟢 LIVE GPS" if bus.get('lat') else "⚪ Ready"
-        coords = f'{float(bus["lat"]):.4f}, {float(bus["lng"]):.4f}' if bus.get('lat') else '---'
-        live_section += f'''
-        <div class="col-md-6 col-lg-3">
-            <div class="card border-0 shadow">
-                <div class="card-body text-center p-3">
-                    <h6 class="fw-bold">{bus['bus_name']}</h6>
-                    <small class="text-muted">{bus['route_name']}</small><br>
-                    <span class="badge {'bg-success' if bus.get('lat') else 'bg-secondary'}">{status}</span>
-                    <div class="mt-2"><small>📍 {coords}</small></div>
-                </div>
-            </div>
-        </div>'''
-    live_section += '</div>'
+    # Live GPS Status (नीचे छोटा) – filled from /api/live-buses, so the page
+    # itself only changes with the reference data and keeps its ETag
+    live_section = '''
+    <h3 class="text-center mb-4">🟢 Live Running Buses</h3>
+    <div id="liveBuses" class="row g-4">
+        <div class="col-12 text-center text-muted">⚪ अभी कोई बस live नहीं है</div>
+    </div>
+    <script>
+    function liveCard(bus) {
+        const col = document.createElement('div');
+        col.className = 'col-md-6 col-lg-3';
+        col.innerHTML = '<div class="card border-0 shadow"><div class="card-body text-center p-3">'
+            + '<h6 class="fw-bold"></h6><small class="text-muted"></small><br>'
+            + '<span class="badge bg-success">🟢 LIVE GPS</span>'
+            + '<div class="mt-2"><small class="coords"></small></div>'
+            + '<div><small class="text-muted seen"></small></div>'
+            + '<a class="stretched-link"></a></div></div>';
+        col.querySelector('h6').textContent = bus.bus_name;
+        col.querySelector('small.text-muted').textContent = bus.route_name;
+        col.querySelector('.coords').textContent = '📍 ' + bus.lat.toFixed(4) + ', ' + bus.lng.toFixed(4);
+        col.querySelector('.seen').textContent = '⏱️ ' + new Date(bus.last_seen * 1000).toLocaleTimeString();
+        col.querySelector('a').href = '/live-bus/' + bus.sid;
+        return col;
+    }
+    function loadLiveBuses() {
+        fetch('/api/live-buses').then(r => r.json()).then(data => {
+            if (!data.ok) return;
+            const box = document.getElementById('liveBuses');
+            if (!data.buses.length) {
+                box.innerHTML = '<div class="col-12 text-center text-muted">⚪ अभी कोई बस live नहीं है</div>';
+                return;
+            }
+            box.replaceChildren(...data.buses.map(liveCard));
+        }).catch(() => {});
+    }
+    loadLiveBuses();
+    setInterval(loadLiveBuses, 15000);
+    </script>
+    '''
 
     content = hero_section + routes_section + live_section
     return render_template_string(BASE_HTML, content=content)
@@ -570,12 +2670,34 @@ def dashboard():
                 <a href="/" class="btn btn-primary">🏠 Home</a>
                 <a href="/logout" class="btn btn-danger ms-2">🚪 Logout</a>
             </div>
+
+            <div class="card mx-auto mt-4 p-3 text-start" style="max-width:600px">
+                <h5>🚌🚌 Bunching alerts</h5>
+                <div id="bunching" class="small text-muted">No bunched buses</div>
+            </div>
         </div>
+
+        <!-- socket.io comes from BASE_HTML after this content, hence DOMContentLoaded -->
+        <script>
+        document.addEventListener('DOMContentLoaded', () => {{
+            const adminSocket = io({{transports:["websocket","polling"]}});
+            adminSocket.on('connect', () => adminSocket.emit('join_admin', {{}}));
+            adminSocket.on('bunching_alert', a => {{
+                const box = document.getElementById('bunching');
+                if(box.classList.contains('text-muted')) {{ box.innerHTML = ''; box.classList.remove('text-muted'); }}
+                const line = document.createElement('div');
+                line.className = a.event === 'bunching' ? 'text-danger' : 'text-success';
+                line.innerText = new Date(a.t * 1000).toLocaleTimeString() + ' · Route ' + a.route_id + ': Bus '
+                    + a.follower + ' → Bus ' + a.leader
+                    + (a.event === 'bunching' ? ' bunched, ' + a.headway_min + ' min / ' + a.gap_km + ' km behind'
+                                              : ' cleared');
+                box.prepend(line);
+            }});
+        }});
+        </script>
         """
     )
-@app.route("/buses/<int:rid>")
-@safe_db
-def buses(rid):
+def load_route_listing(rid):
     conn, cur = get_db()
 
     # Route details + stations
@@ -590,14 +2712,15 @@ def buses(rid):
     route = cur.fetchone()
 
     if not route:
-        return "Route not found", 404
+        return None, []
 
     # All buses of this route
     cur.execute("""
         SELECT s.id, s.bus_name, s.departure_time, s.total_seats,
-               s.current_lat, s.current_lng,
+               p.lat as current_lat, p.lng as current_lng,
                COALESCE(bk.count, 0) as booked_count
         FROM schedules s 
+        LEFT JOIN bus_positions p ON p.schedule_id = s.id
         LEFT JOIN (
             SELECT schedule_id, COUNT(*) as count 
             FROM seat_bookings 
@@ -607,7 +2730,17 @@ def buses(rid):
         WHERE s.route_id = %s 
         ORDER BY s.departure_time
     """, (rid,))
-    buses_data = cur.fetchall()
+    return route, cur.fetchall()
+
+
+@app.route("/buses/<int:rid>")
+@conditional_get("ref", "bookings", "gps_online", extra=lambda: [date.today()])
+@safe_db
+def buses(rid):
+    route, buses_data = reads.do(("route", rid, date.today()), lambda: load_route_listing(rid))
+
+    if not route:
+        return "Route not found", 404
 
     html = f"""
     <div class="text-center mb-5 booking-header">
@@ -634,7 +2767,7 @@ def buses(rid):
                     <div class="card shadow-lg border-0 bus-card">
                         <div class="card-body p-4 text-center">
 
-                            <span class="badge {badge} float-end">
+                            <span id="gps-{bus['id']}" class="badge {badge} float-end">
                                 {gps_status}
                             </span>
 
@@ -687,6 +2820,30 @@ def buses(rid):
     </div>
     """
 
+    # live badges: one bus_frame per tick with every bus of this route that moved.
+    # socket.io comes from BASE_HTML after this content, hence DOMContentLoaded
+    html += f"""
+    <script src="{asset_url('js/wire.js')}"></script>
+    <script>
+    function showFrame(frame) {{
+        frame.buses.forEach(([sid, lat, lng, speed]) => {{
+            const badge = document.getElementById('gps-' + sid);
+            if(!badge) return;
+            badge.className = 'badge bg-success float-end';
+            badge.innerText = '🟢 LIVE ' + Math.round(speed) + ' km/h';
+        }});
+    }}
+    document.addEventListener('DOMContentLoaded', () => {{
+        const routeSocket = io({{transports:["websocket","polling"]}});
+        // compact binary frames when the decoder loaded, JSON otherwise
+        const wire = typeof BusWire !== 'undefined' ? 'bin' : 'json';
+        routeSocket.on('connect', () => routeSocket.emit('join_route', {{route_id: {rid}, wire: wire}}));
+        routeSocket.on('bus_frame', showFrame);
+        routeSocket.on('bus_frame_bin', data => showFrame(BusWire.decode(data)));
+    }});
+    </script>
+    """
+
     return render_template_string(BASE_HTML, content=html)
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -788,14 +2945,7 @@ def select(sid):
     return render_template_string(BASE_HTML, content=form)
 
 
-@app.route("/seats/<int:sid>")
-@safe_db
-def seats(sid):
-
-    fs = request.args.get("fs", "बीकानेर")
-    ts = request.args.get("ts", "जयपुर")
-    d  = request.args.get("d", date.today().isoformat())
-
+def load_seat_map(sid, fs, ts, d):
     conn, cur = get_db()
 
     # ===== Station Order =====
@@ -827,6 +2977,37 @@ def seats(sid):
         if not (ts_order <= bfs or fs_order >= bts):
             booked_seats.add(r["seat_number"])
 
+    # ===== Bus + Map =====
+    cur.execute("""
+        SELECT s.route_id, p.lat, p.lng
+        FROM schedules s LEFT JOIN bus_positions p ON p.schedule_id = s.id
+        WHERE s.id=%s
+    """, (sid,))
+    bus = cur.fetchone()
+
+    return {
+        "booked_seats": frozenset(booked_seats),
+        "lat": float(bus["lat"] or 27.2),
+        "lng": float(bus["lng"] or 75.0),
+        "route_id": bus["route_id"],
+    }
+
+
+@app.route("/seats/<int:sid>")
+@safe_db
+def seats(sid):
+
+    fs = request.args.get("fs", "बीकानेर")
+    ts = request.args.get("ts", "जयपुर")
+    d  = request.args.get("d", date.today().isoformat())
+
+    seat_map = reads.do(("seats", sid, fs, ts, d), lambda: load_seat_map(sid, fs, ts, d))
+    booked_seats = seat_map["booked_seats"]
+    # freshest position comes from the live store, the table is the fallback
+    live = live_buses.get(sid) or seat_map
+    lat, lng = live["lat"], live["lng"]
+    shape_url = route_shape_url(seat_map["route_id"])
+
     # ===== Seat Buttons =====
     seat_buttons = ""
     total_seats = 40
@@ -842,25 +3023,6 @@ def seats(sid):
                 {i}
             </button>'''
 
-    # ===== Bus + Map =====
-    cur.execute("""
-        SELECT current_lat, current_lng, route_id
-        FROM schedules WHERE id=%s
-    """, (sid,))
-    bus = cur.fetchone()
-
-    lat = float(bus["current_lat"] or 27.2)
-    lng = float(bus["current_lng"] or 75.0)
-
-    cur.execute("""
-        SELECT lat, lng, station_name
-        FROM route_stations
-        WHERE route_id=%s
-        ORDER BY station_order
-    """, (bus["route_id"],))
-    import json
-    stations_json = json.dumps(cur.fetchall(), ensure_ascii=False)
-
     role = session.get("role", "user")
     user_id = session.get("user_id", 0)
     counter_no = session.get("counter_no", None)
@@ -870,6 +3032,7 @@ def seats(sid):
 <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
 <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
 <script src="https://cdn.socket.io/4.7.5/socket.io.min.js"></script>
+<script src="{asset_url('js/route_shape.js')}"></script>
 
 <style>
 #seat-map{{height:260px;border-radius:20px;margin-bottom:20px;}}
@@ -896,21 +3059,8 @@ let bookingLock = false;
 const map = L.map("seat-map").setView([{lat},{lng}], 9);
 L.tileLayer("https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png").addTo(map);
 
-const stations = {stations_json};
-let routePts = [];
-
-stations.forEach(s => {{
-    let la = parseFloat(s.lat), ln = parseFloat(s.lng);
-    if(!isNaN(la) && !isNaN(ln)){{
-        routePts.push([la,ln]);
-        L.marker([la,ln]).addTo(map).bindPopup(s.station_name);
-    }}
-}});
-
-if(routePts.length>1){{
-    let p = L.polyline(routePts).addTo(map);
-    map.fitBounds(p.getBounds());
-}}
+const shapeUrl = {json.dumps(shape_url)};
+if(shapeUrl) RouteShape.draw(map, shapeUrl);
 
 const socket = io();
 socket.on("seat_update", d => {{
@@ -1064,6 +3214,7 @@ def book():
         ))
 
         conn.commit()
+        bump_version("bookings")
 
         # ===== LIVE UPDATE =====
         socketio.emit("seat_update", {
@@ -1151,6 +3302,44 @@ def driver(sid):
         const socket = io({{ transports: ["websocket", "polling"] }});
         let watchId = null;
 
+        // fixes wait here until the server has acknowledged them, so nothing is
+        // lost while the network is down; they go up in batches once it's back
+        const BUFFER_MAX = 2000;
+        const BATCH_SIZE = 200;
+        let pending = [];
+        let sending = false;
+
+        function flushFixes() {{
+            if (sending || !pending.length) return;
+            if (!socket.connected && !navigator.onLine) return;
+            const batch = pending.splice(0, BATCH_SIZE);
+            sending = true;
+
+            const done = function (ok) {{
+                sending = false;
+                if (!ok) {{
+                    pending = batch.concat(pending).slice(-BUFFER_MAX);
+                    return;
+                }}
+                flushFixes();
+            }};
+
+            if (socket.connected) {{
+                socket.timeout(5000).emit("driver_gps_batch", {{ sid: {sid}, sent_at: Date.now(), fixes: batch }},
+                    function (err, res) {{ done(!err && res && res.ok); }});
+            }} else {{
+                fetch("/api/driver/{sid}/gps-batch", {{
+                    method: "POST",
+                    headers: {{ "Content-Type": "application/json" }},
+                    body: JSON.stringify({{ sent_at: Date.now(), fixes: batch }})
+                }}).then(function (r) {{ done(r.ok); }}).catch(function () {{ done(false); }});
+            }}
+        }}
+
+        socket.on("connect", flushFixes);
+        window.addEventListener("online", flushFixes);
+        setInterval(flushFixes, 10000);
+
         function startGPS() {{
             const startBtn = document.getElementById("startBtn");
             const stopBtn = document.getElementById("stopBtn");
@@ -1172,15 +3361,18 @@ def driver(sid):
                     const lat = pos.coords.latitude.toFixed(6);
                     const lng = pos.coords.longitude.toFixed(6);
 
-                    const data = {{
-                        sid: {sid},
+                    pending.push({{
                         lat: lat,
-                        lng: lng
-                    }};
-
-                    socket.emit("driver_gps", data);
-
-                    status.innerHTML = "✅ LIVE GPS<br>Latitude: " + lat + "<br>Longitude: " + lng;
+                        lng: lng,
+                        speed: pos.coords.speed != null ? (pos.coords.speed * 3.6).toFixed(1) : 0,
+                        accuracy: Math.round(pos.coords.accuracy),
+                        timestamp: pos.timestamp
+                    }});
+                    if (pending.length > BUFFER_MAX) pending.shift();
+                    flushFixes();
+
+                    status.innerHTML = "✅ LIVE GPS<br>Latitude: " + lat + "<br>Longitude: " + lng
+                        + (pending.length > 1 ? "<br>📦 " + pending.length + " fixes बाकी (offline)" : "");
                     startBtn.innerHTML = "🚗 Live GPS चल रहा है";
                 }},
                 function (err) {{
@@ -1221,39 +3413,38 @@ def driver(sid):
 """
 
 
-@app.route("/live-bus/<int:sid>")
-@safe_db
-def live_bus(sid):
+def load_live_bus(sid):
     conn, cur = get_db()
 
     # Bus + Route info
     cur.execute("""
         SELECT s.id, s.bus_name, s.departure_time,
                r.id as route_id, r.route_name, r.distance_km,
-               s.current_lat as lat, s.current_lng as lng
+               p.lat, p.lng
         FROM schedules s 
         JOIN routes r ON s.route_id = r.id 
+        LEFT JOIN bus_positions p ON p.schedule_id = s.id
         WHERE s.id = %s
     """, (sid,))
     bus = cur.fetchone()
 
+    return bus
+
+
+@app.route("/live-bus/<int:sid>")
+@safe_db
+def live_bus(sid):
+    bus = reads.do(("live_bus", sid), lambda: load_live_bus(sid))
+
     if not bus:
         return "Bus not found", 404
 
-    lat = float(bus.get('lat', 27.2))
-    lng = float(bus.get('lng', 74.2))
+    live = live_buses.get(sid)
+    if live:
+        bus = dict(bus, lat=live["lat"], lng=live["lng"])
 
-    # Route Stations for Polyline
-    cur.execute("""
-        SELECT lat, lng, station_name
-        FROM route_stations
-        WHERE route_id=%s
-        ORDER BY station_order
-    """, (bus['route_id'],))
-    stations = cur.fetchall()
-
-    import json
-    stations_json = json.dumps(stations)  # ✅ Python side JSON
+    lat = float(bus.get('lat') or 27.2)
+    lng = float(bus.get('lng') or 74.2)
 
     content = f'''
     <style>
@@ -1275,11 +3466,19 @@ def live_bus(sid):
         <div class="col-lg-12">
             <div id="map" class="rounded-4"></div>
         </div>
+        <div class="col-lg-12">
+            <div class="card stats-card border-0 shadow rounded-4">
+                <h5 class="mb-2">⏱️ Arrival Times</h5>
+                <div id="eta-list" class="text-muted">Waiting for GPS...</div>
+            </div>
+        </div>
     </div>
 
     <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
     <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
     <script src="https://cdn.socket.io/4.7.5/socket.io.min.js"></script>
+    <script src="{asset_url('js/wire.js')}"></script>
+    <script src="{asset_url('js/route_shape.js')}"></script>
 
     <script>
     const map = L.map('map').setView([{lat}, {lng}], {13 if bus.get('lat') else 10});
@@ -1288,27 +3487,14 @@ def live_bus(sid):
     }}).addTo(map);
 
     // ===== ROUTE POLYLINE =====
-    const stations = {stations_json};
-    let routePoints = [];
-
-    stations.forEach(st => {{
-        const lat = parseFloat(st.lat);
-        const lng = parseFloat(st.lng);
-        if(!isNaN(lat) && !isNaN(lng)){{
-            routePoints.push([lat,lng]);
-            // Station markers
-            L.marker([lat,lng]).addTo(map).bindPopup("📍 " + st.station_name);
-        }}
-    }});
-
+    const shapeUrl = {json.dumps(route_shape_url(bus['route_id']))};
     let routeLine = null;
-    if(routePoints.length > 1){{
-        routeLine = L.polyline(routePoints, {{
-            color: 'Blue',   // thick red polyline
-            weight: 8,
-            opacity: 0.9
-        }}).addTo(map);
-        map.fitBounds(routeLine.getBounds());
+    if(shapeUrl){{
+        RouteShape.draw(map, shapeUrl, {{color: 'Blue', weight: 8, opacity: 0.9}}).then(line => {{
+            routeLine = line;
+            // no fix yet: park the bus at the first station
+            if(!{'true' if bus.get('lat') else 'false'}) busMarker.setLatLng(line.getLatLngs()[0]);
+        }});
     }}
 
     // ===== BUS ICON =====
@@ -1317,30 +3503,222 @@ def live_bus(sid):
         className: 'bus-icon',
         iconSize: [60,60]
     }});
-    let busMarker = L.marker(routePoints[0] || [{lat},{lng}], {{icon: busIcon}}).addTo(map);
+    let busMarker = L.marker([{lat},{lng}], {{icon: busIcon}}).addTo(map);
 
     // ===== SOCKET LIVE UPDATE =====
     const sid = {sid};
     const socket = io({{transports:["websocket","polling"]}});
 
+    // compact binary fixes when the decoder loaded, JSON otherwise
+    const wire = typeof BusWire !== 'undefined' ? 'bin' : 'json';
+
     socket.on('connect', () => {{
         console.log('✅ Socket Connected');
+        // (re)join this bus's room, the server only sends its fixes there
+        socket.emit('join_bus', {{sid: sid, wire: wire}});
     }});
 
-    socket.on('bus_location', data => {{
-        if(data.sid == sid){{
-            const lat = parseFloat(data.lat);
-            const lng = parseFloat(data.lng);
-            busMarker.setLatLng([lat,lng]);
-            if(routeLine) map.panTo([lat,lng], {{animate:true}});
-        }}
+    function moveBus(busSid, lat, lng) {{
+        if(busSid != sid) return;
+        busMarker.setLatLng([lat,lng]);
+        if(routeLine) map.panTo([lat,lng], {{animate:true}});
+    }}
+    socket.on('bus_location', data => moveBus(data.sid, parseFloat(data.lat), parseFloat(data.lng)));
+    socket.on('bus_location_bin', data => {{
+        BusWire.decode(data).buses.forEach(([busSid, lat, lng]) => moveBus(busSid, lat, lng));
     }});
+
+    // ===== ETA =====
+    function showEta(eta){{
+        const box = document.getElementById('eta-list');
+        if(!eta.stops.length){{ box.innerText = '🏁 Last station reached'; return; }}
+        box.innerHTML = eta.stops.map(s =>
+            `<div class="d-flex justify-content-between border-bottom py-1">
+                <span>📍 ${{s.station}}</span>
+                <span>${{s.km}} km · <b>${{s.eta_min}} min</b></span>
+             </div>`).join('');
+    }}
+    socket.on('bus_eta', eta => {{ if(eta.sid == sid) showEta(eta); }});
+    fetch('/api/eta/' + sid).then(r => r.json()).then(eta => {{ if(eta.ok) showEta(eta); }});
     </script>
     '''
 
     return render_template_string(BASE_HTML, content=content)
 
 
+# ================= TRIP REPLAY =================
+# Streams a bus's stored track for one (local) day. Points are read in
+# REPLAY_CHUNK-sized keyset pages, each page borrowing a pool connection only
+# for its own query, so neither memory nor a DB connection is held for the
+# whole day. Points are [unix_ts, lat, lng, speed_kmh].
+#
+# Several fixes can share a timestamp (and the tiers have no row id), so a
+# page starts at the last page's timestamp and skips the rows with that
+# timestamp it already returned, in a fully deterministic order.
+REPLAY_CHUNK = int(os.getenv("REPLAY_CHUNK", 500))
+REPLAY_MAX_GAP = float(os.getenv("REPLAY_MAX_GAP", 2))
+REPLAY_DEFAULT_SPEED = 60
+REPLAY_MAX_SPEED = 3600
+TRACK_TZ = ZoneInfo(os.getenv("TRACK_TZ", "Asia/Kolkata"))
+
+
+def iter_track(sid, day):
+    after = datetime.combine(day, datetime.min.time(), TRACK_TZ)
+    end = after + timedelta(days=1)
+    skip = 0  # rows at exactly `after` already returned
+    while True:
+        with pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT ts, lat_e6, lng_e6, speed_dkmh FROM (
+                    SELECT 0 AS tier, ts, lat_e6, lng_e6, speed_dkmh FROM gps_tracks
+                    WHERE schedule_id = %(sid)s AND ts >= %(after)s AND ts < %(end)s
+                    UNION ALL
+                    SELECT 1, ts, lat_e6, lng_e6, speed_dkmh FROM gps_tracks_1m
+                    WHERE schedule_id = %(sid)s AND ts >= %(after)s AND ts < %(end)s
+                    UNION ALL
+                    SELECT 2, ts, lat_e6, lng_e6, speed_dkmh FROM gps_tracks_10m
+                    WHERE schedule_id = %(sid)s AND ts >= %(after)s AND ts < %(end)s
+                ) t
+                ORDER BY ts, tier, lat_e6, lng_e6, speed_dkmh
+                OFFSET %(skip)s LIMIT %(limit)s
+            """, {"sid": sid, "after": after, "end": end, "skip": skip, "limit": REPLAY_CHUNK}).fetchall()
+        if not rows:
+            return
+        yield [[round(ts.timestamp(), 1), lat / 1e6, lng / 1e6, spd / 10] for ts, lat, lng, spd in rows]
+        if len(rows) < REPLAY_CHUNK:
+            return
+        last = rows[-1][0]
+        same = sum(1 for r in rows if r[0] == last)
+        skip = skip + same if last == after else same
+        after = last
+
+
+def parse_replay_day(value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@app.route("/api/replay/<int:sid>/<day>")
+@staff_required
+def replay_http(sid, day):
+    day = parse_replay_day(day)
+    if day is None:
+        return jsonify({"ok": False, "error": "date must be YYYY-MM-DD"}), 400
+
+    def generate():
+        yield f'{{"ok": true, "sid": {sid}, "date": "{day}", "points": ['
+        first = True
+        for chunk in iter_track(sid, day):
+            body = json.dumps(chunk)[1:-1]
+            yield body if first else "," + body
+            first = False
+        yield "]}"
+
+    return Response(generate(), mimetype="application/json")
+
+
+def replay_room(sid, day, client):
+    return f"replay:{sid}:{day}:{client}"
+
+
+def run_socket_replay(room, sid, day, speed):
+    """Re-emit a stored day as bus_location events, `speed` times faster."""
+    prev = None
+    for chunk in iter_track(sid, day):
+        for ts, lat, lng, spd in chunk:
+            if room not in _active_replays:
+                return
+            if prev is not None:
+                socketio.sleep(min((ts - prev) / speed, REPLAY_MAX_GAP))
+            prev = ts
+            socketio.emit("bus_location", {
+                "sid": sid, "lat": lat, "lng": lng, "speed": spd,
+                "timestamp": ts, "replay": True,
+            }, to=room)
+    socketio.emit("replay_done", {"sid": sid, "date": str(day)}, to=room)
+    _active_replays.discard(room)
+
+
+_active_replays = set()
+
+
+def parse_replay_speed(value):
+    try:
+        speed = float(REPLAY_DEFAULT_SPEED if value is None else value)
+    except (TypeError, ValueError):
+        return REPLAY_DEFAULT_SPEED
+    if not math.isfinite(speed):
+        return REPLAY_DEFAULT_SPEED
+    return min(max(speed, 1.0), REPLAY_MAX_SPEED)
+
+
+@socketio.on("replay_start")
+def on_replay_start(data):
+    if not session.get("user_logged_in"):
+        return {"ok": False, "error": "Login required"}
+    sid = _room_id(data, "sid")
+    day = parse_replay_day((data or {}).get("date"))
+    if sid is None or day is None:
+        return {"ok": False, "error": "sid and date (YYYY-MM-DD) required"}
+    speed = parse_replay_speed((data or {}).get("speed"))
+
+    room = replay_room(sid, day, request.sid)
+    join_room(room)
+    if room not in _active_replays:
+        _active_replays.add(room)
+        socketio.start_background_task(run_socket_replay, room, sid, day, speed)
+    return {"ok": True, "room": room}
+
+
+@socketio.on("replay_stop")
+def on_replay_stop(data):
+    sid = _room_id(data, "sid")
+    room = replay_room(sid, parse_replay_day((data or {}).get("date")), request.sid)
+    _active_replays.discard(room)
+    leave_room(room)
+    return {"ok": True}
+
+
+@socketio.on("disconnect")
+def on_disconnect():
+    # a closed tab stops its replays instead of streaming the rest of the day to nobody
+    suffix = f":{request.sid}"
+    for room in [r for r in _active_replays if r.endswith(suffix)]:
+        _active_replays.discard(room)
+
+# ================= METRICS =================
+# Internal counters for staff, or for scripts (gps_bench.py) that send
+# METRICS_API_KEY in X-Metrics-Key.
+METRICS_API_KEY = os.getenv("METRICS_API_KEY")
+
+
+@app.route("/api/metrics")
+def metrics():
+    key = request.headers.get("X-Metrics-Key")
+    if not session.get("user_logged_in") and not (
+            METRICS_API_KEY and key and hmac.compare_digest(key, METRICS_API_KEY)):
+        return jsonify({"ok": False, "error": "Login required"}), 403
+    return jsonify({
+        "response_cache": response_cache.stats(),
+        "single_flight": reads.stats(),
+        "shared_cache": shared_cache.stats() if shared_cache else None,
+        "gps_write_behind": gps_writer.stats(),
+        "route_frames": route_frames.stats(),
+        "track_compactor": track_compactor.stats(),
+        "eta_engine": eta_engine.stats(),
+        "geofences": geofences.stats(),
+        "gps_filter": gps_filter.stats(),
+        "nearby": nearby.stats(),
+        "headways": headways.stats(),
+        "gps_rate_limit": gps_limiter.stats(),
+        "dead_reckoning": dead_reckoning.stats(),
+        "process": {"pid": os.getpid(), "cpu_s": round(time.process_time(), 3),
+                    "threads": threading.active_count()},
+    })
+
+
 @app.route("/create-payment", methods=["POST"])
 def create_payment():
     if not RAZORPAY_ENABLED:
@@ -1391,6 +3769,7 @@ def verify():
     """, (data['sid'], data['seat']))
 
     conn.commit()
+    bump_version("bookings")
 
     socketio.emit("seat_update", {
         "sid": data['sid'],
@@ -0,0 +1,81 @@
+"""
+Static asset build step.
+
+Copies every file under static/ to static/dist/ with a content hash in its
+name (css/style.css -> css/style.1a2b3c4d.css), writes .gz and .br variants
+for text assets and a manifest.json that app.py uses for asset_url().
+
+Run it once per deploy, before gunicorn starts:
+
+    python build_static.py
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip variants are always written
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+
+# images are already compressed, only text gets .gz / .br siblings
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".html", ".txt", ".map"}
+
+
+def hashed_name(rel_path, data):
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    root, ext = os.path.splitext(rel_path)
+    return f"{root}.{digest}{ext}"
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def build():
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest = {}
+
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if os.path.abspath(root).startswith(DIST_DIR):
+            continue
+        for name in sorted(files):
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, STATIC_DIR).replace(os.sep, "/")
+            with open(src, "rb") as f:
+                data = f.read()
+
+            out_rel = hashed_name(rel, data)
+            out = os.path.join(DIST_DIR, out_rel)
+            write_file(out, data)
+
+            encodings = []
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                if brotli is not None:
+                    br = brotli.compress(data, quality=11)
+                    if len(br) < len(data):
+                        write_file(out + ".br", br)
+                        encodings.append("br")
+                gz = gzip.compress(data, compresslevel=9, mtime=0)
+                if len(gz) < len(data):
+                    write_file(out + ".gz", gz)
+                    encodings.append("gzip")
+
+            manifest[rel] = {"path": out_rel, "encodings": encodings}
+            print(f"📦 {rel} → {out_rel} {' '.join(encodings)}")
+
+    write_file(MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode())
+    print(f"✅ {len(manifest)} assets written to {DIST_DIR}")
+
+
+if __name__ == "__main__":
+    build()
@@ -0,0 +1,299 @@
+"""
+Geometry helpers for the live GPS pipeline.
+
+Routes are polylines through their route_stations. Distances are in km on a
+local equirectangular projection (x = lng * cos(lat0), y = lat), which is
+accurate to well under 1% across a single Rajasthan route and lets the whole
+fleet be projected with a handful of NumPy array operations.
+"""
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEG = math.radians(1) * EARTH_RADIUS_KM
+
+
+def fast_distance_km(lat1, lng1, lat2, lng2):
+    """Equirectangular distance, plenty for the few km between two fixes."""
+    kx = math.cos(math.radians((lat1 + lat2) / 2))
+    return KM_PER_DEG * math.hypot((lng2 - lng1) * kx, lat2 - lat1)
+
+
+class RouteGeometry:
+    """One route's station polyline with cumulative distances."""
+
+    def __init__(self, route_id, stations):
+        # stations: [(station_name, lat, lng), ...] in station_order
+        self.route_id = route_id
+        self.names = [s[0] for s in stations]
+        self.lat = np.array([s[1] for s in stations], dtype=float)
+        self.lng = np.array([s[2] for s in stations], dtype=float)
+        self.lat0 = float(self.lat.mean()) if len(stations) else 0.0
+        self.kx = KM_PER_DEG * math.cos(math.radians(self.lat0))
+
+        self.x = self.lng * self.kx
+        self.y = self.lat * KM_PER_DEG
+        self.seg_dx = np.diff(self.x)
+        self.seg_dy = np.diff(self.y)
+        self.seg_len = np.hypot(self.seg_dx, self.seg_dy)
+        self.cum = np.concatenate([[0.0], np.cumsum(self.seg_len)])
+        # plain-float copies for the per-fix scalar paths (numpy indexing is slow there)
+        self._pts = list(zip(self.x.tolist(), self.y.tolist()))
+        self._cum = self.cum.tolist()
+
+    @property
+    def n_segments(self):
+        return len(self.seg_len)
+
+    def station_distance_km(self, j, lat, lng):
+        return math.hypot(lng * self.kx - self.x[j], lat * KM_PER_DEG - self.y[j])
+
+    def snap(self, lat, lng, seg, window=2):
+        """Closest point on segments seg-window..seg+window.
+
+        Returns (lat, lng, segment, off-route km); a few microseconds, used per fix.
+        """
+        px, py = lng * self.kx, lat * KM_PER_DEG
+        best = (lat, lng, seg, math.inf)
+        for i in range(max(seg - window, 0), min(seg + window + 1, len(self._pts) - 1)):
+            (ax, ay), (bx, by) = self._pts[i], self._pts[i + 1]
+            dx, dy = bx - ax, by - ay
+            len2 = dx * dx + dy * dy
+            t = min(max(((px - ax) * dx + (py - ay) * dy) / len2, 0.0), 1.0) if len2 else 0.0
+            cx, cy = ax + t * dx, ay + t * dy
+            d = math.hypot(px - cx, py - cy)
+            if d < best[3]:
+                best = (cy / KM_PER_DEG, cx / self.kx, i, d)
+        return best
+
+    def simplify(self, tolerance_km):
+        """Douglas-Peucker: indexes of the points to keep so none dropped is further off than tolerance_km."""
+        n = len(self.x)
+        if n < 3:
+            return np.arange(n)
+        keep = np.zeros(n, dtype=bool)
+        keep[[0, -1]] = True
+        stack = [(0, n - 1)]
+        while stack:
+            a, b = stack.pop()
+            if b - a < 2:
+                continue
+            dx, dy = self.x[b] - self.x[a], self.y[b] - self.y[a]
+            px, py = self.x[a + 1:b] - self.x[a], self.y[a + 1:b] - self.y[a]
+            length = math.hypot(dx, dy)
+            d = np.abs(px * dy - py * dx) / length if length else np.hypot(px, py)
+            i = int(np.argmax(d))
+            if d[i] > tolerance_km:
+                keep[a + 1 + i] = True
+                stack += [(a, a + 1 + i), (a + 1 + i, b)]
+        return np.flatnonzero(keep)
+
+    def locate(self, lat, lng):
+        """(along-track km, segment, off-route km) of one point; None without a segment (< 2 stations)."""
+        if not self.n_segments:
+            return None
+        px, py = lng * self.kx, lat * KM_PER_DEG
+        ax, ay = self.x[:-1], self.y[:-1]
+        len2 = self.seg_len ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(len2 > 0, ((px - ax) * self.seg_dx + (py - ay) * self.seg_dy) / len2, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        d = np.hypot(px - (ax + t * self.seg_dx), py - (ay + t * self.seg_dy))
+        i = int(np.argmin(d))
+        return float(self.cum[i] + t[i] * self.seg_len[i]), i, float(d[i])
+
+
+def encode_polyline(points, precision=5):
+    """Google encoded polyline of [(lat, lng), ...], as understood by most map libraries."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        lat, lng = round(lat * factor), round(lng * factor)
+        for delta in (lat - prev_lat, lng - prev_lng):
+            v = ~(delta << 1) if delta < 0 else delta << 1
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1F)) + 63))
+                v >>= 5
+            out.append(chr(v + 63))
+        prev_lat, prev_lng = lat, lng
+    return "".join(out)
+
+
+class FleetGeometry:
+    """All routes packed into padded 2-D arrays, one row per route.
+
+    Lets project_fleet() handle every active bus in one vectorized pass.
+    Padding segments have infinite distance and padding stations NaN.
+    """
+
+    def __init__(self, routes):
+        routes = [r for r in routes if r.n_segments > 0]
+        self.routes = routes
+        self.row = {r.route_id: i for i, r in enumerate(routes)}
+        n = len(routes)
+        max_seg = max((r.n_segments for r in routes), default=1)
+
+        self.kx = np.array([r.kx for r in routes])
+        self.ax = np.zeros((n, max_seg))
+        self.ay = np.zeros((n, max_seg))
+        self.dx = np.zeros((n, max_seg))
+        self.dy = np.zeros((n, max_seg))
+        self.len = np.zeros((n, max_seg))
+        self.cum_start = np.zeros((n, max_seg))
+        self.valid = np.zeros((n, max_seg), dtype=bool)
+        self.station_cum = np.full((n, max_seg + 1), np.nan)
+
+        for i, r in enumerate(routes):
+            k = r.n_segments
+            self.ax[i, :k] = r.x[:-1]
+            self.ay[i, :k] = r.y[:-1]
+            self.dx[i, :k] = r.seg_dx
+            self.dy[i, :k] = r.seg_dy
+            self.len[i, :k] = r.seg_len
+            self.cum_start[i, :k] = r.cum[:-1]
+            self.valid[i, :k] = True
+            self.station_cum[i, :k + 1] = r.cum
+
+
+def project_fleet(fleet, rows, lat, lng):
+    """Project N buses onto their routes at once.
+
+    rows: route row index per bus (FleetGeometry.row), lat/lng: arrays of N.
+    Returns (along_km, segment, off_route_km), each an array of N.
+    """
+    rows = np.asarray(rows, dtype=int)
+    px = (np.asarray(lng, dtype=float) * fleet.kx[rows])[:, None]
+    py = (np.asarray(lat, dtype=float) * KM_PER_DEG)[:, None]
+
+    ax, ay = fleet.ax[rows], fleet.ay[rows]
+    dx, dy, length = fleet.dx[rows], fleet.dy[rows], fleet.len[rows]
+    len2 = length * length
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(len2 > 0, ((px - ax) * dx + (py - ay) * dy) / len2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+
+    d2 = (px - (ax + t * dx)) ** 2 + (py - (ay + t * dy)) ** 2
+    d2[~fleet.valid[rows]] = np.inf
+
+    seg = np.argmin(d2, axis=1)
+    pick = np.arange(len(rows))
+    along = fleet.cum_start[rows, seg] + t[pick, seg] * length[pick, seg]
+    return along, seg, np.sqrt(d2[pick, seg])
+
+
+class GridIndex:
+    """Points bucketed into a uniform lat/lng grid.
+
+    update()/remove() are O(1); radius() and nearest() only look at the cells
+    around the query point, so they stay well under a millisecond for a
+    fleet-sized index. Whenever that neighbourhood would hold more cells than
+    the index has occupied cells (large radii, or near the poles where cells
+    have almost no width) the query scans the points directly instead, so it
+    never costs more than a full scan.
+
+    Buckets are replaced, never changed in place, so copy() is a cheap
+    snapshot that can be queried while the original keeps changing.
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell = cell_deg
+        self._cells = {}  # (row, col) -> {key: (lat, lng)}
+        self._where = {}  # key -> (row, col)
+
+    def __len__(self):
+        return len(self._where)
+
+    def _cell_of(self, lat, lng):
+        return int(math.floor(lat / self.cell)), int(math.floor(lng / self.cell))
+
+    def _discard(self, cell, key):
+        bucket = dict(self._cells[cell])
+        del bucket[key]
+        if bucket:
+            self._cells[cell] = bucket
+        else:
+            del self._cells[cell]
+
+    def update(self, key, lat, lng):
+        cell = self._cell_of(lat, lng)
+        old = self._where.get(key)
+        if old is not None and old != cell:
+            self._discard(old, key)
+        bucket = dict(self._cells.get(cell, ()))
+        bucket[key] = (lat, lng)
+        self._cells[cell] = bucket
+        self._where[key] = cell
+
+    def remove(self, key):
+        cell = self._where.pop(key, None)
+        if cell is not None:
+            self._discard(cell, key)
+
+    def copy(self):
+        snapshot = GridIndex(self.cell)
+        snapshot._cells = dict(self._cells)
+        snapshot._where = dict(self._where)
+        return snapshot
+
+    def _ring(self, row, col, r):
+        if r == 0:
+            yield row, col
+            return
+        for c in range(col - r, col + r + 1):
+            yield row - r, c
+            yield row + r, c
+        for rr in range(row - r + 1, row + r):
+            yield rr, col - r
+            yield rr, col + r
+
+    def _ring_km(self, lat):
+        """Distance every point in rings 0..r-1 is guaranteed to be within, per ring."""
+        lat = min(abs(lat) + self.cell, 90.0)
+        return self.cell * KM_PER_DEG * max(math.cos(math.radians(lat)), 1e-9)
+
+    def _scan(self, lat, lng, km):
+        found = [(fast_distance_km(lat, lng, plat, plng), key, plat, plng)
+                 for bucket in self._cells.values() for key, (plat, plng) in bucket.items()]
+        found = [f for f in found if f[0] <= km]
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def radius(self, lat, lng, km):
+        """[(distance_km, key, lat, lng)] within `km`, nearest first."""
+        rings = km / self._ring_km(lat) + 1
+        if (2 * rings - 1) ** 2 > len(self._cells):
+            return self._scan(lat, lng, km)
+        row, col = self._cell_of(lat, lng)
+        found = []
+        for r in range(int(math.ceil(rings))):
+            for cell in self._ring(row, col, r):
+                for key, (plat, plng) in self._cells.get(cell, {}).items():
+                    d = fast_distance_km(lat, lng, plat, plng)
+                    if d <= km:
+                        found.append((d, key, plat, plng))
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def nearest(self, lat, lng, k, max_km=500):
+        """The k closest points (up to max_km away), nearest first."""
+        row, col = self._cell_of(lat, lng)
+        ring_km = self._ring_km(lat)
+        found = []
+        r = scanned = 0
+        while len(found) < len(self._where) and r * ring_km <= max_km + ring_km:
+            scanned += 8 * r or 1
+            if scanned > len(self._cells):
+                return self._scan(lat, lng, max_km)[:k]
+            for cell in self._ring(row, col, r):
+                for key, (plat, plng) in self._cells.get(cell, {}).items():
+                    d = fast_distance_km(lat, lng, plat, plng)
+                    if d <= max_km:
+                        found.append((d, key, plat, plng))
+            found.sort(key=lambda f: f[0])
+            # everything within r rings is at least r * ring_km away when unseen
+            if len(found) >= k and found[k - 1][0] <= r * ring_km:
+                break
+            r += 1
+        return found[:k]
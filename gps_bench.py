@@ -0,0 +1,362 @@
+"""
+Load benchmark for the driver_gps pipeline.
+
+Connects --buses Socket.IO clients that each send driver_gps for one
+schedule every --interval seconds, and --viewers passive clients subscribed
+to those buses (join_bus) or their routes (join_route). Positions are
+synthetic, buses drive up and down their route's stations, or with
+--replay the schedules' recorded gps_tracks fixes are sent again in order.
+
+After --warmup seconds it measures, until --duration:
+    ingest      fixes sent, and accepted / rate-limited / filtered by the server
+    fan-out     bus_location and bus_frame deliveries, latency percentiles
+                (send -> viewer; frames include up to ROUTE_FRAME_MS batching)
+    DB          commits and rows written per table (pg_stat_*)
+    worker CPU  of the process answering /api/metrics
+
+Everything is local: start the app against a local Postgres with one worker,
+then point the benchmark at it (same DATABASE_URL, and the same
+METRICS_API_KEY so it can read /api/metrics). Under gthread every open
+socket holds a thread, so --threads must cover buses + viewers:
+
+    export METRICS_API_KEY=bench
+    gunicorn app:app --worker-class gthread --threads 1500 --bind 127.0.0.1:10000 &
+    python gps_bench.py --buses 200 --viewers 1000 --duration 60
+    python gps_bench.py --buses 50 --viewers 100 --replay
+
+--make-schedules adds bench-<n> schedules when the database has fewer than
+--buses; the app picks them up after REF_DATA_TTL (or a restart).
+"""
+import argparse
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psycopg
+import requests
+import socketio
+from dotenv import load_dotenv
+
+from geo import KM_PER_DEG, RouteGeometry
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+METRICS_API_KEY = os.getenv("METRICS_API_KEY")
+CONNECT_WORKERS = 50  # parallel Socket.IO handshakes while setting up
+
+
+# ================= TRACKS =================
+class SyntheticTrack:
+    """Drives back and forth along a route at a constant speed (a straight
+    line from a random point when the route has no usable stations)."""
+
+    def __init__(self, route):
+        self.kmh = random.uniform(20, 60)
+        self.route = route if route is not None and route.cum[-1] > 0 else None
+        if self.route is not None:
+            self.along = random.uniform(0, self.route.cum[-1])
+            self.direction = random.choice((1, -1))
+        else:
+            self.lat = random.uniform(24.5, 29.5)
+            self.lng = random.uniform(70.5, 77.5)
+            self.course = random.uniform(0, 2 * math.pi)
+
+    def next(self, dt):
+        km = self.kmh * dt / 3600
+        if self.route is None:
+            self.lat += km * math.cos(self.course) / KM_PER_DEG
+            self.lng += km * math.sin(self.course) / (KM_PER_DEG * math.cos(math.radians(self.lat)))
+            return self.lat, self.lng, self.kmh
+
+        r = self.route
+        self.along += self.direction * km
+        if not 0 <= self.along <= r.cum[-1]:  # turn round at the terminus
+            self.direction = -self.direction
+            self.along = min(max(self.along, 0.0), r.cum[-1])
+        j = min(int(np.searchsorted(r.cum, self.along, side="right")) - 1, r.n_segments - 1)
+        f = (self.along - r.cum[j]) / r.seg_len[j] if r.seg_len[j] else 0.0
+        return (float(r.lat[j] + f * (r.lat[j + 1] - r.lat[j])),
+                float(r.lng[j] + f * (r.lng[j + 1] - r.lng[j])), self.kmh)
+
+
+class ReplayTrack:
+    """A schedule's recorded fixes, one per call, looping at the end."""
+
+    def __init__(self, fixes):
+        self.fixes = fixes
+        self.i = 0
+
+    def next(self, dt):
+        fix = self.fixes[self.i]
+        self.i = (self.i + 1) % len(self.fixes)
+        return fix
+
+
+# ================= DATABASE =================
+def load_buses(conn, n, make_schedules):
+    """[(schedule_id, route_id)] for n schedules, creating bench ones if asked."""
+    rows = conn.execute("SELECT id, route_id FROM schedules ORDER BY id LIMIT %s", (n,)).fetchall()
+    if len(rows) < n and make_schedules:
+        routes = [r for (r,) in conn.execute("""
+            SELECT route_id FROM route_stations WHERE lat IS NOT NULL AND lng IS NOT NULL
+            GROUP BY route_id HAVING count(*) > 1""")]
+        if not routes:
+            raise SystemExit("❌ no route with two or more located stations to put bench schedules on")
+        # init_db seeds schedules with explicit ids without advancing the sequence
+        conn.execute("SELECT setval(pg_get_serial_sequence('schedules', 'id'), max(id)) FROM schedules")
+        for i in range(len(rows), n):
+            conn.execute("INSERT INTO schedules (route_id, bus_name, departure_time) VALUES (%s, %s, '06:00')",
+                         (routes[i % len(routes)], f"bench-{i}"))
+        conn.commit()
+        print(f"🆕 added {n - len(rows)} bench schedules, the app sees them after REF_DATA_TTL or a restart")
+        rows = conn.execute("SELECT id, route_id FROM schedules ORDER BY id LIMIT %s", (n,)).fetchall()
+    if len(rows) < n:
+        print(f"⚠️ only {len(rows)} schedules in the database, benchmarking {len(rows)} buses "
+              f"(--make-schedules adds more)")
+    return rows
+
+
+def load_routes(conn):
+    stations = {}
+    for rid, name, lat, lng in conn.execute("""
+            SELECT route_id, station_name, lat, lng FROM route_stations
+            WHERE lat IS NOT NULL AND lng IS NOT NULL
+            ORDER BY route_id, station_order"""):
+        stations.setdefault(rid, []).append((name, lat, lng))
+    return {rid: RouteGeometry(rid, st) for rid, st in stations.items() if len(st) > 1}
+
+
+def load_recorded(conn, sids):
+    """{sid: [(lat, lng, speed), ...]} from gps_tracks, oldest first."""
+    tracks = {}
+    for sid, lat, lng, speed in conn.execute("""
+            SELECT schedule_id, lat_e6, lng_e6, speed_dkmh FROM gps_tracks
+            WHERE schedule_id = ANY(%s) ORDER BY schedule_id, ts""", (sids,)):
+        tracks.setdefault(sid, []).append((lat / 1e6, lng / 1e6, (speed or 0) / 10))
+    return tracks
+
+
+def db_snapshot(conn):
+    """(commits, {table: rows inserted + updated + deleted})"""
+    conn.execute("SELECT pg_stat_clear_snapshot()")
+    commits = conn.execute(
+        "SELECT xact_commit FROM pg_stat_database WHERE datname = current_database()").fetchone()[0]
+    rows = dict(conn.execute("SELECT relname, n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables"))
+    return commits, rows
+
+
+# ================= CLIENTS =================
+class Recorder:
+    """Counters and latency samples shared by every client thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.measuring = False
+        self.sent = 0
+        self.received = 0
+        self.predicted = 0
+        self.bus_ms = []
+        self.frame_ms = []
+        self.last_sent = {}  # sid -> send time of its newest fix
+
+    def count(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def sample(self, samples, ms):
+        if self.measuring:
+            with self.lock:
+                samples.append(ms)
+
+
+def connect(url):
+    client = socketio.Client(reconnection=False)
+    client.connect(url, transports=["websocket"], wait_timeout=30)
+    return client
+
+
+def add_viewer(url, rec, sid, rid):
+    client = socketio.Client(reconnection=False)
+
+    if rid is None:
+        @client.on("bus_location")
+        def on_location(data):
+            rec.count("received")
+            if data.get("predicted"):
+                rec.count("predicted")
+                return
+            rec.sample(rec.bus_ms, time.time() * 1000 - float(data["timestamp"]))
+    else:
+        seen = {}  # sid -> send time already accounted for
+
+        @client.on("bus_frame")
+        def on_frame(frame):
+            now = time.time()
+            rec.count("received", len(frame["buses"]))
+            for bus in frame["buses"]:
+                t = rec.last_sent.get(bus[0])
+                if t is not None and seen.get(bus[0]) != t:  # skips dead-reckoned repeats
+                    seen[bus[0]] = t
+                    rec.sample(rec.frame_ms, (now - t) * 1000)
+
+    client.connect(url, transports=["websocket"], wait_timeout=30)
+    if rid is None:
+        client.emit("join_bus", {"sid": sid})
+    else:
+        client.emit("join_route", {"route_id": rid})
+    return client
+
+
+def drive(buses, interval, until, rec):
+    """Sends every bus's next fix once per interval, spread evenly over it."""
+    step = interval / len(buses)
+    due = time.time()
+    behind = 0.0
+    while time.time() < until:
+        for sid, client, track in buses:
+            lat, lng, speed = track.next(interval)
+            now = time.time()
+            client.emit("driver_gps", {"sid": sid, "lat": round(lat, 6), "lng": round(lng, 6),
+                                       "speed": round(speed, 1), "accuracy": 10, "timestamp": now * 1000})
+            rec.last_sent[sid] = now
+            rec.count("sent")
+            due += step
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                behind = max(behind, -wait)
+    if behind > interval:
+        print(f"⚠️ the sender fell {behind:.1f}s behind schedule, the rate sent is below the rate asked for")
+
+
+def report(rec, until, every=5):
+    last_sent, last_received = rec.sent, rec.received
+    while time.time() < until:
+        time.sleep(every)
+        print(f"📤 {(rec.sent - last_sent) / every:.0f} fixes/s sent, "
+              f"📥 {(rec.received - last_received) / every:.0f} positions/s received", flush=True)
+        last_sent, last_received = rec.sent, rec.received
+
+
+# ================= RESULTS =================
+def percentiles(samples):
+    if not samples:
+        return "no samples"
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return f"p50 {p50:.0f} ms, p90 {p90:.0f} ms, p99 {p99:.0f} ms, max {max(samples):.0f} ms ({len(samples)} samples)"
+
+
+def delta(after, before, *path):
+    for key in path:
+        after, before = after[key], before[key]
+    return after - before
+
+
+def print_results(rec, seconds, sent, received, m0, m1, db0, db1, n_viewers):
+    print(f"\n===== {seconds:.0f}s measured =====")
+    accepted = delta(m1, m0, "gps_rate_limit", "accepted")
+    limited = delta(m1, m0, "gps_rate_limit", "dropped")
+    rejected = {k: delta(m1, m0, "gps_filter", "rejected", k) for k in m1["gps_filter"]["rejected"]}
+    print(f"📤 ingest: {sent / seconds:.0f} fixes/s sent, {accepted / seconds:.0f}/s accepted, "
+          f"{limited} rate limited, filter rejected {rejected}")
+    print(f"📡 fan-out: {received / seconds:.0f} positions/s to {n_viewers} viewers "
+          f"({rec.predicted} dead-reckoned bus_location)")
+    print(f"⏱️ bus_location: {percentiles(rec.bus_ms)}")
+    print(f"⏱️ bus_frame:    {percentiles(rec.frame_ms)}")
+
+    writes = {t: n - db0[1].get(t, 0) for t, n in db1[1].items()}
+    top = ", ".join(f"{t} {n / seconds:.0f}" for t, n in sorted(writes.items(), key=lambda w: -w[1])[:5] if n)
+    w = m1["gps_write_behind"]
+    print(f"🗄️ DB: {(db1[0] - db0[0]) / seconds:.1f} commits/s, rows/s: {top or 'none'}; "
+          f"write-behind avg flush {w['avg_flush_ms']} ms, {w['errors']} errors")
+
+    p0, p1 = m0["process"], m1["process"]
+    if p0["pid"] != p1["pid"]:
+        print("🖥️ worker CPU: /api/metrics answered by different workers, run the app with one worker")
+    else:
+        cpu = p1["cpu_s"] - p0["cpu_s"]
+        print(f"🖥️ worker {p1['pid']}: {cpu / seconds * 100:.0f}% CPU ({cpu:.1f}s in {seconds:.0f}s), "
+              f"{p1['threads']} threads")
+
+
+def fetch_metrics(url):
+    r = requests.get(f"{url}/api/metrics", headers={"X-Metrics-Key": METRICS_API_KEY or ""}, timeout=10)
+    if r.status_code == 403:
+        raise SystemExit("❌ /api/metrics refused: run the app and the benchmark with the same METRICS_API_KEY")
+    r.raise_for_status()
+    return r.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for the driver_gps pipeline")
+    parser.add_argument("--url", default=os.getenv("APP_URL", "http://localhost:10000"))
+    parser.add_argument("--buses", type=int, default=50)
+    parser.add_argument("--viewers", type=int, default=100)
+    parser.add_argument("--route-viewers", type=float, default=0.5,
+                        help="share of viewers on join_route instead of join_bus")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between fixes per bus")
+    parser.add_argument("--duration", type=float, default=60, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=10)
+    parser.add_argument("--replay", action="store_true", help="send recorded gps_tracks instead of synthetic fixes")
+    parser.add_argument("--make-schedules", action="store_true")
+    args = parser.parse_args()
+
+    with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+        rows = load_buses(conn, args.buses, args.make_schedules)
+        routes = load_routes(conn)
+        recorded = load_recorded(conn, [sid for sid, _ in rows]) if args.replay else {}
+    if not rows:
+        raise SystemExit("❌ no schedules to benchmark")
+    if args.replay:
+        print(f"🎞️ replaying recorded tracks for {len(recorded)} of {len(rows)} buses, synthetic for the rest")
+
+    rec = Recorder()
+    print(f"🔌 connecting {len(rows)} buses and {args.viewers} viewers to {args.url}")
+    try:
+        with ThreadPoolExecutor(CONNECT_WORKERS) as pool:
+            drivers = list(pool.map(lambda _: connect(args.url), rows))
+            n_route = round(args.viewers * args.route_viewers)
+            viewers = list(pool.map(
+                lambda i: add_viewer(args.url, rec, rows[i % len(rows)][0],
+                                     rows[i % len(rows)][1] if i < n_route else None),
+                range(args.viewers)))
+    except socketio.exceptions.ConnectionError as e:
+        raise SystemExit(f"❌ Socket.IO connection failed ({e}); is the app running, "
+                         f"with enough threads for {len(rows) + args.viewers} sockets?")
+    buses = [(sid, client, ReplayTrack(recorded[sid]) if sid in recorded else SyntheticTrack(routes.get(rid)))
+             for (sid, rid), client in zip(rows, drivers)]
+
+    started = time.time()
+    until = started + args.warmup + args.duration
+    sender = threading.Thread(target=drive, args=(buses, args.interval, until, rec), daemon=True)
+    sender.start()
+    threading.Thread(target=report, args=(rec, until), daemon=True).start()
+
+    time.sleep(args.warmup)
+    with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+        m0 = fetch_metrics(args.url)
+        db0 = db_snapshot(conn)
+        sent0, received0, t0 = rec.sent, rec.received, time.time()
+        rec.measuring = True
+
+        sender.join()
+        rec.measuring = False
+        seconds = time.time() - t0
+        sent, received = rec.sent - sent0, rec.received - received0
+        time.sleep(2)  # let the write-behind flush and backends report their stats
+        m1 = fetch_metrics(args.url)
+        db1 = db_snapshot(conn)
+
+    print_results(rec, seconds, sent, received, m0, m1, db0, db1, len(viewers))
+    for client in drivers + viewers:
+        client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
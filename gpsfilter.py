@@ -0,0 +1,99 @@
+"""
+Plausibility filter for incoming GPS fixes.
+
+Phone GPS jumps around (urban canyons, stale cached fixes). Before a fix is
+stored or fanned out it must be a real position, newer than the bus's last
+accepted fix, reasonably accurate and reachable at a plausible speed; if it
+is within snap_km of the route polyline it is snapped onto it. After reset_s
+without an accepted fix the next one is trusted, so a bus is never stuck
+behind one bad fix.
+
+Kept free of Flask and the database so it can be tested on its own; app.py
+configures the limits from the environment.
+"""
+import math
+import threading
+import time
+
+from geo import fast_distance_km
+
+
+def gps_accuracy(value):
+    """Reported accuracy in metres; None when missing or not a number."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def gps_speed(value):
+    """Reported speed in km/h; 0 when missing, negative or not a finite number."""
+    try:
+        value = float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return value if math.isfinite(value) and value > 0 else 0.0
+
+
+def valid_position(lat, lng):
+    """True for a finite lat/lng inside the usual ranges."""
+    return math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180
+
+
+class GpsFilter:
+    def __init__(self, max_speed_kmh=130, max_accuracy_m=250, max_age_s=120, snap_km=0.075, reset_s=180):
+        self.max_speed_kmh = max_speed_kmh
+        self.max_accuracy_m = max_accuracy_m
+        self.max_age_s = max_age_s
+        self.snap_km = snap_km
+        self.reset_s = reset_s
+        self._lock = threading.Lock()
+        self._last = {}  # sid -> [lat, lng, fix time, route segment or None]
+        self.accepted = 0
+        self.snapped = 0
+        self.rejected = {"invalid": 0, "stale": 0, "accuracy": 0, "speed": 0}
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return None
+
+    def apply(self, sid, route, lat, lng, t, accuracy=None, max_age=None):
+        """(lat, lng) to store, snapped onto `route` if close to it; None if rejected."""
+        accuracy = gps_accuracy(accuracy)
+        with self._lock:
+            if not valid_position(lat, lng):
+                return self._reject("invalid")
+            if accuracy is not None and accuracy > self.max_accuracy_m:
+                return self._reject("accuracy")
+            if t < time.time() - (max_age or self.max_age_s):
+                return self._reject("stale")
+
+            last = self._last.get(sid)
+            if last is not None:
+                dt = t - last[2]
+                if dt <= 0:
+                    return self._reject("stale")  # replayed or out-of-order fix
+                if dt < self.reset_s:
+                    kmh = fast_distance_km(last[0], last[1], lat, lng) / (dt / 3600)
+                    if kmh > self.max_speed_kmh:
+                        return self._reject("speed")
+
+            seg = None
+            if route is not None:
+                if last is not None and last[3] is not None:
+                    s_lat, s_lng, seg, off = route.snap(lat, lng, last[3])
+                else:
+                    loc = route.locate(lat, lng)
+                    s_lat, s_lng, seg, off = (route.snap(lat, lng, loc[1], window=0) if loc
+                                              else (lat, lng, None, math.inf))
+                if off <= self.snap_km:
+                    lat, lng = s_lat, s_lng
+                    self.snapped += 1
+
+            self._last[sid] = [lat, lng, t, seg]
+            self.accepted += 1
+            return lat, lng
+
+    def stats(self):
+        return {"accepted": self.accepted, "snapped": self.snapped, "rejected": dict(self.rejected)}
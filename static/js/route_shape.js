@@ -0,0 +1,42 @@
+// Draws a route from its /route-shape/... asset (route_shapes() in app.py):
+// a marker per station and the encoded polyline level for the map's zoom.
+const RouteShape = (function () {
+    // Google encoded polyline -> [[lat, lng], ...]
+    function decode(str) {
+        const points = [];
+        let i = 0, lat = 0, lng = 0;
+        while (i < str.length) {
+            for (const axis of [0, 1]) {
+                let shift = 0, result = 0, b;
+                do {
+                    b = str.charCodeAt(i++) - 63;
+                    result |= (b & 0x1f) << shift;
+                    shift += 5;
+                } while (b >= 0x20);
+                const delta = result & 1 ? ~(result >> 1) : result >> 1;
+                if (axis === 0) lat += delta; else lng += delta;
+            }
+            points.push([lat / 1e5, lng / 1e5]);
+        }
+        return points;
+    }
+
+    function levelFor(levels, zoom) {
+        let best = levels[0];
+        levels.forEach(level => { if (level[0] <= zoom) best = level; });
+        return decode(best[1]);
+    }
+
+    // resolves to the L.polyline, after fitting the map to it
+    function draw(map, url, style) {
+        return fetch(url).then(r => r.json()).then(shape => {
+            shape.stations.forEach(([name, lat, lng]) => L.marker([lat, lng]).addTo(map).bindPopup("📍 " + name));
+            const line = L.polyline(levelFor(shape.levels, map.getZoom()), style).addTo(map);
+            map.on("zoomend", () => line.setLatLngs(levelFor(shape.levels, map.getZoom())));
+            if (shape.stations.length > 1) map.fitBounds(line.getBounds());
+            return line;
+        });
+    }
+
+    return {decode: decode, draw: draw};
+})();
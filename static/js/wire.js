@@ -0,0 +1,42 @@
+// Decoder for the compact position frames from wire.py (bus_frame_bin /
+// bus_location_bin). Frames arrive base64-encoded; decode() returns
+// {route_id, t, buses: [[sid, lat, lng, speed], ...]}.
+const BusWire = (function () {
+    const VERSION = 1;
+    const SCALE = 1000000;
+
+    function decode(text) {
+        const raw = atob(text);
+        const bytes = new Uint8Array(raw.length);
+        for (let i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+        let pos = 1;
+
+        // plain arithmetic, not bit ops: t needs more than 32 bits
+        function read() {
+            let n = 0, mul = 1, b;
+            do {
+                b = bytes[pos++];
+                n += (b & 0x7f) * mul;
+                mul *= 128;
+            } while (b >= 0x80);
+            return n;
+        }
+        function signed() {
+            const n = read();
+            return n % 2 ? -(n + 1) / 2 : n / 2;
+        }
+
+        if (bytes[0] !== VERSION) throw new Error("unknown frame version " + bytes[0]);
+        const frame = {route_id: read(), t: read() / 10, buses: []};
+        let sid = 0, lat = 0, lng = 0;
+        for (let count = read(); count > 0; count--) {
+            sid += read();
+            lat += signed();
+            lng += signed();
+            frame.buses.push([sid, lat / SCALE, lng / SCALE, read()]);
+        }
+        return frame;
+    }
+
+    return {decode: decode};
+})();
@@ -0,0 +1,56 @@
+import random
+import time
+
+from geo import GridIndex, RouteGeometry, fast_distance_km
+
+
+def test_locate_single_station_route():
+    route = RouteGeometry(1, [("Bikaner", 28.0, 73.3)])
+    assert route.n_segments == 0
+    assert route.locate(28.01, 73.31) is None
+
+
+def test_locate_on_route():
+    route = RouteGeometry(1, [("A", 28.0, 73.0), ("B", 28.0, 73.1), ("C", 28.1, 73.1)])
+    along, seg, off = route.locate(28.0, 73.05)
+    assert seg == 0
+    assert off < 0.01
+    assert abs(along - route.cum[1] / 2) < 0.01
+
+
+def _fleet(n=500, seed=7):
+    rng = random.Random(seed)
+    index = GridIndex(0.05)
+    for key in range(n):
+        index.update(key, rng.uniform(26, 30), rng.uniform(72, 76))
+    return index
+
+
+def test_grid_matches_brute_force():
+    index = _fleet()
+    points = {key: index._cells[cell][key] for key, cell in index._where.items()}
+    for lat, lng, km in [(28.0, 74.0, 5), (27.5, 73.2, 40), (28.0, 74.0, 500)]:
+        want = sorted(key for key, (plat, plng) in points.items()
+                      if fast_distance_km(lat, lng, plat, plng) <= km)
+        assert sorted(f[1] for f in index.radius(lat, lng, km)) == want
+        nearest = [f[1] for f in index.nearest(lat, lng, 5, km)]
+        assert nearest == [f[1] for f in index._scan(lat, lng, km)[:5]]
+
+
+def test_grid_near_pole_is_fast():
+    index = _fleet()
+    index.update("polar", 89.92, 10.0)
+    started = time.perf_counter()
+    assert [f[1] for f in index.radius(89.9, 0, 5)] == ["polar"]
+    assert index.nearest(89.9, 0, 1)[0][1] == "polar"
+    assert time.perf_counter() - started < 0.1
+
+
+def test_grid_copy_is_a_snapshot():
+    index = GridIndex(0.05)
+    index.update(1, 28.0, 73.0)
+    snapshot = index.copy()
+    index.update(1, 28.5, 73.5)
+    index.update(2, 28.0, 73.0)
+    assert [f[1] for f in snapshot.radius(28.0, 73.0, 1)] == [1]
+    assert len(snapshot) == 1
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from geo import RouteGeometry
+from gpsfilter import GpsFilter, gps_speed, valid_position
+
+ROUTE = RouteGeometry(1, [("A", 28.0, 73.0), ("B", 28.0, 73.1), ("C", 28.1, 73.1)])
+
+
+@pytest.fixture
+def gps():
+    return GpsFilter(max_speed_kmh=130, max_accuracy_m=250, max_age_s=120, snap_km=0.075, reset_s=180)
+
+
+@pytest.mark.parametrize("lat, lng", [
+    (float("nan"), 73.0), (28.0, float("nan")), (float("inf"), 73.0), (28.0, float("-inf")),
+    (90.5, 73.0), (28.0, -181.0),
+])
+def test_rejects_impossible_positions(gps, lat, lng):
+    assert gps.apply(1, ROUTE, lat, lng, time.time()) is None
+    assert gps.apply(1, None, lat, lng, time.time()) is None
+    assert gps.rejected["invalid"] == 2
+    assert gps.accepted == 0
+
+
+def test_accuracy(gps):
+    now = time.time()
+    assert gps.apply(1, None, 28.0, 73.0, now, accuracy=500) is None
+    assert gps.rejected["accuracy"] == 1
+    assert gps.apply(1, None, 28.0, 73.0, now, accuracy=20) == (28.0, 73.0)
+    # junk accuracy is ignored, not fatal
+    assert gps.apply(2, None, 28.0, 73.0, now, accuracy="abc") == (28.0, 73.0)
+    assert gps.apply(3, None, 28.0, 73.0, now, accuracy=float("nan")) == (28.0, 73.0)
+
+
+def test_stale(gps):
+    now = time.time()
+    assert gps.apply(1, None, 28.0, 73.0, now - 600) is None
+    assert gps.apply(1, None, 28.0, 73.0, now - 600, max_age=3600) is not None
+    assert gps.apply(1, None, 28.0, 73.0, now - 601, max_age=3600) is None  # out of order
+    assert gps.apply(1, None, 28.0, 73.0, now - 600, max_age=3600) is None  # replayed
+    assert gps.rejected["stale"] == 3
+
+
+def test_speed(gps):
+    now = time.time()
+    assert gps.apply(1, None, 28.0, 73.0, now - 10) is not None
+    # ~11 km in 10 s
+    assert gps.apply(1, None, 28.1, 73.0, now) is None
+    assert gps.rejected["speed"] == 1
+    # ~100 m in 10 s is 36 km/h
+    assert gps.apply(1, None, 28.0009, 73.0, now) is not None
+
+
+def test_trusts_next_fix_after_reset(gps):
+    now = time.time()
+    assert gps.apply(1, None, 28.0, 73.0, now - 200, max_age=3600) is not None
+    assert gps.apply(1, None, 28.5, 73.0, now) is not None
+
+
+def test_snaps_onto_route(gps):
+    now = time.time()
+    lat, lng = gps.apply(1, ROUTE, 28.0003, 73.05, now - 5)  # ~33 m north of A-B
+    assert lat == pytest.approx(28.0, abs=1e-6)
+    assert lng == pytest.approx(73.05, abs=1e-4)
+    assert gps.snapped == 1
+    # far off the route: kept as reported
+    assert gps.apply(2, ROUTE, 28.05, 73.05, now) == (28.05, 73.05)
+    assert gps.snapped == 1
+
+
+def test_helpers():
+    assert valid_position(28.0, 73.0) and valid_position(-90, 180)
+    assert not valid_position(float("nan"), 73.0) and not valid_position(28.0, 181)
+    assert gps_speed("42.5") == 42.5
+    assert gps_speed(None) == gps_speed("fast") == gps_speed("nan") == gps_speed(-3) == gps_speed("inf") == 0.0
@@ -0,0 +1,15 @@
+import pytest
+
+from wire import decode_frame, encode_frame
+
+
+def test_frame_round_trip():
+    buses = [[12, 28.012345, 73.312345, 41], [3, -33.9, -70.6, 0]]
+    route_id, t, decoded = decode_frame(encode_frame(7, 1700000000.4, buses))
+    assert (route_id, t) == (7, 1700000000.4)
+    assert decoded == [[3, -33.9, -70.6, 0], [12, 28.012345, 73.312345, 41]]
+
+
+def test_negative_sid_is_rejected():
+    with pytest.raises(ValueError, match="non-negative"):
+        encode_frame(0, 1700000000, [[-1, 28.0, 73.0, 10]])
@@ -0,0 +1,42 @@
+"""GpsWriteBehind against a real database; skipped without DATABASE_URL."""
+import os
+import time
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs DATABASE_URL")
+
+SID = 2_000_000_000  # far above any real schedule id
+
+
+@pytest.fixture
+def app_module():
+    import app
+    yield app
+    with app.pool.connection() as conn:
+        for table in ("bus_positions", "gps_tracks", "station_events"):
+            conn.execute(f"DELETE FROM {table} WHERE schedule_id >= %s", (SID,))
+
+
+def _count(app, table):
+    with app.pool.connection() as conn:
+        return conn.execute(f"SELECT count(*) FROM {table} WHERE schedule_id >= %s", (SID,)).fetchone()[0]
+
+
+def test_events_are_written_without_fixes(app_module):
+    writer = app_module.GpsWriteBehind(3600)
+    writer.add_event({"sid": SID, "route_id": 1, "station": "A", "index": 0, "event": "arrive", "t": time.time()})
+    writer.flush()
+    assert _count(app_module, "station_events") == 1
+    assert writer._events == []
+
+
+def test_unconvertible_row_is_dead_lettered(app_module):
+    writer = app_module.GpsWriteBehind(3600)
+    writer.add(SID, 28.0, float("inf"), 10.0, time.time())
+    writer.add(SID + 1, 28.0, 73.0, 10.0, time.time())
+    writer.flush()
+    assert writer.dead_lettered == 1
+    assert writer.errors == 0
+    assert writer._pending == {} and writer._track == []
+    assert _count(app_module, "gps_tracks") == 1
@@ -0,0 +1,220 @@
+"""
+Segment travel-time and dwell-time statistics from the GPS track history.
+
+For every route, all of its buses' fixes in the window (raw gps_tracks plus
+the 1-minute and 10-minute tiers) are loaded with one binary COPY straight
+into NumPy arrays. A bus is "at" a station while it is within --radius-m of
+it; consecutive fixes at the same station form a visit (arrival = first fix,
+departure = last fix). Visits to adjacent route_stations give a segment
+travel time (departure -> next arrival), each visit gives a dwell time.
+
+Results are grouped by local hour of day (TRACK_TZ) and written to two
+small tables, replacing the previous run:
+
+    segment_stats (route_id, from_index, to_index, hour, samples, median_s, p85_s, mean_s)
+    dwell_stats   (route_id, station_index, hour, samples, median_s, p85_s, mean_s)
+
+Station indexes are 0-based positions in the route's station_order.
+Dwell times from the 1-minute tier are only accurate to about a minute.
+
+    python track_stats.py               # last 30 days
+    python track_stats.py --days 7 --radius-m 300
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import psycopg
+from dotenv import load_dotenv
+from psycopg import sql
+
+from geo import KM_PER_DEG, RouteGeometry
+
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+TRACK_TZ = ZoneInfo(os.getenv("TRACK_TZ", "Asia/Kolkata"))
+VISIT_GAP_S = 600  # a longer silence at a station splits it into two visits
+SEGMENT_MAX_S = 6 * 3600  # slower than this between two stations is not one trip
+
+# binary COPY: 19-byte header, then per row a field count and (length, value)
+# per column, big-endian; every column here is NOT NULL and fixed width
+COPY_HEADER = 19
+COPY_ROW = np.dtype([("n", ">i2"), ("l1", ">i4"), ("sid", ">i4"), ("l2", ">i4"), ("ts", ">f8"),
+                     ("l3", ">i4"), ("lat", ">i4"), ("l4", ">i4"), ("lng", ">i4")])
+
+TRACK_SQL = """
+    COPY (
+        SELECT schedule_id, extract(epoch FROM ts)::float8, lat_e6, lng_e6 FROM (
+            SELECT schedule_id, ts, lat_e6, lng_e6 FROM gps_tracks
+            UNION ALL SELECT schedule_id, ts, lat_e6, lng_e6 FROM gps_tracks_1m
+            UNION ALL SELECT schedule_id, ts, lat_e6, lng_e6 FROM gps_tracks_10m
+        ) t
+        WHERE schedule_id = ANY({sids}) AND ts >= {start} AND ts < {end}
+        ORDER BY schedule_id, ts
+    ) TO STDOUT (FORMAT binary)
+"""
+
+
+def create_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS segment_stats (
+        route_id INT NOT NULL,
+        from_index SMALLINT NOT NULL,
+        to_index SMALLINT NOT NULL,
+        hour SMALLINT NOT NULL,
+        samples INT NOT NULL,
+        median_s INT NOT NULL,
+        p85_s INT NOT NULL,
+        mean_s INT NOT NULL,
+        computed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (route_id, from_index, to_index, hour)
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dwell_stats (
+        route_id INT NOT NULL,
+        station_index SMALLINT NOT NULL,
+        hour SMALLINT NOT NULL,
+        samples INT NOT NULL,
+        median_s INT NOT NULL,
+        p85_s INT NOT NULL,
+        mean_s INT NOT NULL,
+        computed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (route_id, station_index, hour)
+    )""")
+
+
+def load_routes(conn):
+    """{route_id: (RouteGeometry, [schedule ids])}"""
+    stations, sids = {}, {}
+    for rid, name, lat, lng in conn.execute("""
+            SELECT route_id, station_name, lat, lng FROM route_stations
+            WHERE lat IS NOT NULL AND lng IS NOT NULL
+            ORDER BY route_id, station_order"""):
+        stations.setdefault(rid, []).append((name, lat, lng))
+    for sid, rid in conn.execute("SELECT id, route_id FROM schedules"):
+        sids.setdefault(rid, []).append(sid)
+    return {rid: (RouteGeometry(rid, st), sids[rid]) for rid, st in stations.items()
+            if len(st) > 1 and rid in sids}
+
+
+def load_tracks(conn, sids, start, end):
+    """Structured array (sid, ts, lat, lng) of every fix, ordered by sid, ts."""
+    query = sql.SQL(TRACK_SQL).format(sids=sql.Literal(sids), start=sql.Literal(start), end=sql.Literal(end))
+    with conn.cursor() as cur:
+        with cur.copy(query) as copy:
+            data = b"".join(bytes(chunk) for chunk in copy)
+    return np.frombuffer(data, dtype=COPY_ROW, offset=COPY_HEADER,
+                         count=(len(data) - COPY_HEADER - 2) // COPY_ROW.itemsize)
+
+
+def station_at(route, lat, lng, radius_km, chunk=500_000):
+    """Index of the station each fix is within radius_km of, -1 if none."""
+    out = np.empty(len(lat), dtype=np.int64)
+    for i in range(0, len(lat), chunk):  # bounds the fixes x stations matrix
+        x = (lng[i:i + chunk] / 1e6 * route.kx)[:, None]
+        y = (lat[i:i + chunk] / 1e6 * KM_PER_DEG)[:, None]
+        d = np.hypot(x - route.x[None, :], y - route.y[None, :])
+        nearest = np.argmin(d, axis=1)
+        out[i:i + chunk] = np.where(d[np.arange(len(d)), nearest] <= radius_km, nearest, -1)
+    return out
+
+
+def visits(tracks, station):
+    """(sid, station, arrival, departure) arrays, one entry per visit, in time order per bus."""
+    sid, ts = tracks["sid"], tracks["ts"]
+    brk = np.ones(len(ts), dtype=bool)
+    brk[1:] = (station[1:] != station[:-1]) | (sid[1:] != sid[:-1]) | (np.diff(ts) > VISIT_GAP_S)
+    first = np.flatnonzero(brk)
+    last = np.append(first[1:] - 1, len(ts) - 1)
+    keep = station[first] >= 0
+    first, last = first[keep], last[keep]
+    return sid[first], station[first], ts[first], ts[last]
+
+
+def local_hour(ts):
+    # TRACK_TZ offset looked up once per UTC day, so zones with DST work too
+    days, day_of = np.unique((ts // 86400).astype(np.int64), return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(d * 86400 + 43200, TRACK_TZ).utcoffset().total_seconds()
+                        for d in days])
+    return ((ts + offsets[day_of]) // 3600 % 24).astype(np.int16)
+
+
+def group_stats(keys, seconds):
+    """[(key..., samples, median, p85, mean)] for each distinct row of keys."""
+    if not len(seconds):
+        return []
+    order = np.lexsort(keys[::-1])
+    keys, seconds = [k[order] for k in keys], seconds[order]
+    brk = np.ones(len(seconds), dtype=bool)
+    brk[1:] = np.any([k[1:] != k[:-1] for k in keys], axis=0)
+    starts = np.flatnonzero(brk)
+    rows = []
+    for group in np.split(np.arange(len(seconds)), starts[1:]):
+        s = seconds[group]
+        rows.append(tuple(int(k[group[0]]) for k in keys) + (
+            len(s), round(float(np.median(s))), round(float(np.percentile(s, 85))), round(float(s.mean()))))
+    return rows
+
+
+def route_stats(route, tracks, radius_km):
+    sid, station, arrive, depart = visits(tracks, station_at(route, tracks["lat"], tracks["lng"], radius_km))
+
+    # consecutive visits of one bus to neighbouring stations, either direction
+    nxt = np.arange(1, len(sid))
+    prev = nxt - 1
+    trip = ((sid[nxt] == sid[prev]) & (np.abs(station[nxt] - station[prev]) == 1)
+            & (arrive[nxt] - depart[prev] < SEGMENT_MAX_S))
+    prev, nxt = prev[trip], nxt[trip]
+    travel = arrive[nxt] - depart[prev]
+    segments = group_stats([station[prev], station[nxt], local_hour(depart[prev])], travel)
+
+    dwell = group_stats([station, local_hour(arrive)], depart - arrive)
+    return segments, dwell, len(sid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment travel-time and dwell-time statistics")
+    parser.add_argument("--days", type=int, default=30, help="window ending now")
+    parser.add_argument("--radius-m", type=float, default=500, help="distance that counts as at a station")
+    args = parser.parse_args()
+
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=args.days)
+    started = time.perf_counter()
+    with psycopg.connect(DATABASE_URL) as conn:
+        create_tables(conn)
+        segment_rows, dwell_rows, fixes = [], [], 0
+        for rid, (route, sids) in sorted(load_routes(conn).items()):
+            t0 = time.perf_counter()
+            tracks = load_tracks(conn, sids, start, end)
+            t1 = time.perf_counter()
+            segments, dwell, n_visits = route_stats(route, tracks, args.radius_m / 1000)
+            segment_rows += [(rid,) + r for r in segments]
+            dwell_rows += [(rid,) + r for r in dwell]
+            fixes += len(tracks)
+            print(f"🛣️ route {rid}: {len(tracks)} fixes, {n_visits} visits, {len(segments)} segment rows, "
+                  f"{len(dwell)} dwell rows (load {t1 - t0:.2f}s, compute {time.perf_counter() - t1:.2f}s)")
+
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM segment_stats")
+            cur.execute("DELETE FROM dwell_stats")
+            with cur.copy("COPY segment_stats (route_id, from_index, to_index, hour, samples, median_s, p85_s, mean_s) "
+                          "FROM STDIN") as copy:
+                for row in segment_rows:
+                    copy.write_row(row)
+            with cur.copy("COPY dwell_stats (route_id, station_index, hour, samples, median_s, p85_s, mean_s) "
+                          "FROM STDIN") as copy:
+                for row in dwell_rows:
+                    copy.write_row(row)
+        conn.commit()
+
+    print(f"✅ {fixes} fixes over {args.days} days → {len(segment_rows)} segment and "
+          f"{len(dwell_rows)} dwell rows in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Ingestion server for hardware GPS trackers.
+
+Trackers connect over TCP or send UDP datagrams, speaking either NMEA or our
+fixed binary record. Fixes are collected per device and posted to the web
+app's /api/tracker/fixes about once a second, where device ids are mapped to
+schedules (tracker_devices table) and fed into the same pipeline as the
+driver page.
+
+NMEA: a tracker first identifies itself with the proprietary sentence
+    $PMBID,<device_id>*hh
+and then sends $GPRMC / $GNRMC sentences (other sentences are ignored). Over
+UDP every datagram starts with its $PMBID line.
+
+Binary: 25-byte little-endian records, several per datagram / stream
+    magic "MB" | version 1 | device_id u64 | unix time u32 |
+    lat_e6 i32 | lng_e6 i32 | speed in 0.1 km/h u16
+
+A TCP connection's first byte ("$" or "M") picks the protocol.
+
+    TRACKER_API_KEY=... python tracker_server.py   # TCP + UDP on :5023
+    APP_URL=http://localhost:10000 TRACKER_API_KEY=... python tracker_server.py
+    python tracker_server.py --dry-run         # parse and count only (load tests)
+"""
+import argparse
+import asyncio
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+APP_URL = os.getenv("APP_URL", "http://localhost:10000")
+TRACKER_API_KEY = os.getenv("TRACKER_API_KEY")
+TRACKER_PORT = int(os.getenv("TRACKER_PORT", 5023))
+FLUSH_INTERVAL = float(os.getenv("TRACKER_FLUSH_INTERVAL", 1))
+IDLE_TIMEOUT = float(os.getenv("TRACKER_IDLE_TIMEOUT", 300))
+BUFFER_MAX = 50_000  # fixes kept while the app is unreachable, oldest dropped first
+MAX_LINE = 1024  # NMEA sentences are at most 82 characters
+
+BINARY = struct.Struct("<2sBQIiiH")
+BINARY_MAGIC = b"MB"
+KNOTS_TO_KMH = 1.852
+
+
+# ================= NMEA =================
+def nmea_fields(line):
+    """Fields of a checksummed NMEA sentence, or None if it is malformed."""
+    line = line.strip()
+    if not line.startswith("$") or "*" not in line:
+        return None
+    body, _, checksum = line[1:].partition("*")
+    calc = 0
+    for ch in body:
+        calc ^= ord(ch)
+    try:
+        if calc != int(checksum[:2], 16):
+            return None
+    except ValueError:
+        return None
+    return body.split(",")
+
+
+def nmea_coord(value, hemisphere):
+    # ddmm.mmmm / dddmm.mmmm -> decimal degrees
+    dot = value.index(".")
+    deg = float(value[:dot - 2]) + float(value[dot - 2:]) / 60
+    return -deg if hemisphere in ("S", "W") else deg
+
+
+def parse_rmc(fields):
+    """Fix dict from an RMC sentence, None if the receiver has no fix."""
+    # RMC,hhmmss.ss,status,lat,N/S,lng,E/W,knots,course,ddmmyy,...
+    if len(fields) < 10 or fields[2] != "A":
+        return None
+    hhmmss, _, frac = fields[1].partition(".")
+    t = datetime.strptime(fields[9] + hhmmss, "%d%m%y%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+    t += float("0." + frac) if frac else 0.0
+    return {
+        "lat": round(nmea_coord(fields[3], fields[4]), 6),
+        "lng": round(nmea_coord(fields[5], fields[6]), 6),
+        "speed": round(float(fields[7] or 0) * KNOTS_TO_KMH, 1),
+        "timestamp": int(t * 1000),
+    }
+
+
+def parse_binary(record):
+    """(device_id, fix) from one binary record."""
+    magic, version, device, ts, lat, lng, speed = BINARY.unpack(record)
+    if magic != BINARY_MAGIC or version != 1:
+        raise ValueError("bad binary record")
+    return str(device), {"lat": lat / 1e6, "lng": lng / 1e6, "speed": speed / 10, "timestamp": ts * 1000}
+
+
+# ================= SERVER =================
+class TrackerServer:
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.pending = {}  # device_id -> [fix, ...]
+        self.buffered = 0
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.unknown = set()
+        self.connections = 0
+        self.stats = {"fixes": 0, "bad": 0, "dropped": 0, "oversized": 0,
+                      "posts": 0, "post_errors": 0, "post_ms": 0.0}
+
+    def add(self, device_id, fix):
+        if device_id in self.unknown:
+            return
+        self.pending.setdefault(device_id, []).append(fix)
+        self.buffered += 1
+        self.stats["fixes"] += 1
+
+    def handle_nmea(self, device_id, line):
+        fields = nmea_fields(line)
+        if fields is None:
+            self.stats["bad"] += 1
+            return device_id
+        if fields[0] == "PMBID" and len(fields) > 1:
+            return fields[1]
+        if fields[0][2:] == "RMC" and device_id is not None:
+            try:
+                fix = parse_rmc(fields)
+            except ValueError:
+                self.stats["bad"] += 1
+                return device_id
+            if fix:
+                self.add(device_id, fix)
+        return device_id
+
+    def handle_binary(self, data):
+        for i in range(0, len(data) - BINARY.size + 1, BINARY.size):
+            try:
+                self.add(*parse_binary(data[i:i + BINARY.size]))
+            except (ValueError, struct.error):
+                self.stats["bad"] += 1
+
+    async def handle_tcp(self, reader, writer):
+        self.connections += 1
+        device_id = None
+        try:
+            first = await asyncio.wait_for(reader.readexactly(1), IDLE_TIMEOUT)
+            if first == BINARY_MAGIC[:1]:
+                buf = first
+                while True:
+                    buf += await asyncio.wait_for(reader.readexactly(BINARY.size - len(buf)), IDLE_TIMEOUT)
+                    self.handle_binary(buf)
+                    buf = b""
+            else:
+                line = first + await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                while line:
+                    device_id = self.handle_nmea(device_id, line.decode("ascii", "replace"))
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except (asyncio.LimitOverrunError, ValueError):
+            # readline() ran past MAX_LINE without a newline: not NMEA, hang up
+            self.stats["oversized"] += 1
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def handle_datagram(self, data):
+        if data[:2] == BINARY_MAGIC:
+            self.handle_binary(data)
+            return
+        device_id = None
+        for line in data.decode("ascii", "replace").splitlines():
+            device_id = self.handle_nmea(device_id, line)
+
+    def post(self, devices):
+        """Blocking POST of one batch (runs on the executor thread)."""
+        started = time.perf_counter()
+        headers = {"X-Tracker-Key": TRACKER_API_KEY} if TRACKER_API_KEY else {}
+        r = self.session.post(f"{APP_URL}/api/tracker/fixes", json={"devices": devices},
+                              headers=headers, timeout=10)
+        r.raise_for_status()
+        result = r.json()
+        if not result.get("ok"):
+            raise RuntimeError(result.get("error"))
+        self.stats["post_ms"] += (time.perf_counter() - started) * 1000
+        return result
+
+    async def flush_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if not self.pending:
+                continue
+            devices, self.pending, self.buffered = self.pending, {}, 0
+            if self.dry_run:
+                continue
+            try:
+                result = await loop.run_in_executor(self.executor, self.post, devices)
+                self.stats["posts"] += 1
+                for device_id in result.get("unknown", []):
+                    if device_id not in self.unknown:
+                        print(f"⚠️ unknown tracker {device_id}, add it to tracker_devices")
+                    self.unknown.add(device_id)
+            except Exception as e:
+                self.stats["post_errors"] += 1
+                print(f"❌ post failed: {e}")
+                for device_id, fixes in devices.items():  # keep them for the next flush
+                    self.pending[device_id] = fixes + self.pending.get(device_id, [])
+                self.buffered = sum(len(f) for f in self.pending.values())
+                self.trim()
+
+    def trim(self):
+        while self.buffered > BUFFER_MAX:
+            device_id = max(self.pending, key=lambda d: len(self.pending[d]))
+            drop = len(self.pending[device_id]) // 2 or 1
+            del self.pending[device_id][:drop]
+            self.buffered -= drop
+            self.stats["dropped"] += drop
+
+    async def forget_unknown(self):
+        # devices added to tracker_devices later are picked up again
+        while True:
+            await asyncio.sleep(300)
+            self.unknown.clear()
+
+    async def report_forever(self, every=10):
+        last = dict(self.stats)
+        while True:
+            await asyncio.sleep(every)
+            s = self.stats
+            rate = (s["fixes"] - last["fixes"]) / every
+            posts = s["posts"] - last["posts"]
+            avg_ms = (s["post_ms"] - last["post_ms"]) / posts if posts else 0.0
+            print(f"📡 {self.connections} connections, {rate:.0f} fixes/s, {self.buffered} buffered, "
+                  f"{s['bad']} bad, {s['oversized']} oversized lines, {s['dropped']} dropped, {s['post_errors']} post errors, "
+                  f"{avg_ms:.1f} ms/post", flush=True)
+            last = dict(s)
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(data)
+
+
+async def main(host, port, dry_run):
+    server = TrackerServer(dry_run)
+    loop = asyncio.get_running_loop()
+    tcp = await asyncio.start_server(server.handle_tcp, host, port, backlog=4096, limit=MAX_LINE)
+    await loop.create_datagram_endpoint(lambda: UdpProtocol(server), local_addr=(host, port))
+    print(f"🚀 Tracker server on {host}:{port} (TCP + UDP) → {'dry run' if dry_run else APP_URL}")
+    async with tcp:
+        await asyncio.gather(tcp.serve_forever(), server.flush_forever(),
+                             server.forget_unknown(), server.report_forever())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=TRACKER_PORT)
+    parser.add_argument("--dry-run", action="store_true", help="parse and count fixes, don't post them")
+    args = parser.parse_args()
+    if not (TRACKER_API_KEY or args.dry_run):
+        parser.error("TRACKER_API_KEY must be set (the app rejects unauthenticated fixes)")
+    try:
+        asyncio.run(main(args.host, args.port, args.dry_run))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,136 @@
+"""
+Load simulator for tracker_server.py.
+
+Opens one connection per simulated tracker (or sends UDP datagrams) and has
+every tracker report a fix each --interval seconds while driving a straight
+line across Rajasthan. Trackers alternate between NMEA and the binary
+protocol. Device ids are --first-id, --first-id + 1, ...; map them in
+tracker_devices to have the fixes reach a schedule.
+
+    python tracker_server.py --dry-run &
+    python tracker_sim.py --trackers 5000 --interval 1 --duration 60
+    python tracker_sim.py --trackers 5000 --udp
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+from datetime import datetime, timezone
+
+from tracker_server import BINARY, BINARY_MAGIC, KNOTS_TO_KMH
+
+sent = 0
+failed = 0
+
+
+def nmea(body):
+    checksum = 0
+    for ch in body:
+        checksum ^= ord(ch)
+    return f"${body}*{checksum:02X}\r\n"
+
+
+def nmea_coord(value, positive, negative, width):
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    deg = int(value)
+    return f"{deg:0{width}d}{(value - deg) * 60:07.4f}", hemisphere
+
+
+def rmc(t, lat, lng, kmh, course):
+    dt = datetime.fromtimestamp(t, timezone.utc)
+    la, ns = nmea_coord(lat, "N", "S", 2)
+    lo, ew = nmea_coord(lng, "E", "W", 3)
+    return nmea(f"GPRMC,{dt:%H%M%S}.{dt.microsecond // 10000:02d},A,{la},{ns},{lo},{ew},"
+                f"{kmh / KNOTS_TO_KMH:.1f},{course:.1f},{dt:%d%m%y},,")
+
+
+class Tracker:
+    def __init__(self, device_id, binary):
+        self.device_id = device_id
+        self.binary = binary
+        self.lat = random.uniform(24.5, 29.5)
+        self.lng = random.uniform(70.5, 77.5)
+        self.kmh = random.uniform(30, 80)
+        self.course = random.uniform(0, 360)
+
+    def step(self, dt):
+        km = self.kmh * dt / 3600
+        self.lat += km / 111.2 * math.cos(math.radians(self.course))
+        self.lng += km / (111.2 * math.cos(math.radians(self.lat))) * math.sin(math.radians(self.course))
+
+    def hello(self):
+        return b"" if self.binary else nmea(f"PMBID,{self.device_id}").encode()
+
+    def fix(self):
+        t = time.time()
+        if self.binary:
+            return BINARY.pack(BINARY_MAGIC, 1, self.device_id, int(t), round(self.lat * 1e6),
+                               round(self.lng * 1e6), round(self.kmh * 10))
+        return rmc(t, self.lat, self.lng, self.kmh, self.course).encode()
+
+
+async def run_tcp(tracker, host, port, interval, until):
+    global sent, failed
+    await asyncio.sleep(random.uniform(0, interval))  # spread the fleet over the interval
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        failed += 1
+        return
+    writer.write(tracker.hello())
+    while time.time() < until:
+        tracker.step(interval)
+        writer.write(tracker.fix())
+        await writer.drain()
+        sent += 1
+        await asyncio.sleep(interval)
+    writer.close()
+
+
+async def run_udp(tracker, transport, interval, until):
+    global sent
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.time() < until:
+        tracker.step(interval)
+        transport.sendto(tracker.hello() + tracker.fix())
+        sent += 1
+        await asyncio.sleep(interval)
+
+
+async def report(until, every=5):
+    last, started = 0, time.time()
+    while time.time() < until:
+        await asyncio.sleep(every)
+        print(f"📤 {sent - last} fixes in {every}s ({(sent - last) / every:.0f}/s), "
+              f"{failed} failed connections, {time.time() - started:.0f}s", flush=True)
+        last = sent
+
+
+async def main(args):
+    trackers = [Tracker(args.first_id + i, binary=i % 2 == 1) for i in range(args.trackers)]
+    until = time.time() + args.duration
+    if args.udp:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                           remote_addr=(args.host, args.port))
+        jobs = [run_udp(t, transport, args.interval, until) for t in trackers]
+    else:
+        jobs = [run_tcp(t, args.host, args.port, args.interval, until) for t in trackers]
+    print(f"🚌 {args.trackers} trackers → {args.host}:{args.port} over {'UDP' if args.udp else 'TCP'}, "
+          f"one fix per {args.interval}s for {args.duration}s")
+    await asyncio.gather(report(until), *jobs)
+    print(f"✅ sent {sent} fixes, {failed} failed connections")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load simulator for tracker_server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5023)
+    parser.add_argument("--trackers", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between fixes per tracker")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--first-id", type=int, default=100000)
+    parser.add_argument("--udp", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+"""
+Compact binary encoding for live position messages.
+
+A frame carries any number of bus positions:
+
+    version(1) route_id t n  then per bus:  sid lat lng speed
+
+every field after the version byte is a LEB128 varint. t is unix time in
+tenths of a second, lat/lng are fixed-point micro-degrees (~0.1 m) and speed
+is whole km/h. Buses are sorted by sid and sid/lat/lng are stored as the
+(zig-zag encoded) difference to the previous bus, so buses on one route cost
+a few bytes each. A single-bus bus_location is a frame with route_id 0.
+
+Frames go over Socket.IO base64-encoded: a real binary attachment costs a
+~50 byte placeholder packet, more than a one-bus frame itself.
+static/js/wire.js is the browser decoder.
+"""
+import base64
+
+VERSION = 1
+SCALE = 1_000_000
+
+
+def _varint(out, n):
+    if n < 0:
+        raise ValueError(f"varint fields must be non-negative, got {n}")
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def encode_frame(route_id, t, buses):
+    """buses: [[sid, lat, lng, speed], ...] -> bytes."""
+    out = bytearray([VERSION])
+    _varint(out, route_id)
+    _varint(out, int(round(t * 10)))
+    _varint(out, len(buses))
+    p_sid = p_lat = p_lng = 0
+    for sid, lat, lng, speed in sorted(buses, key=lambda b: b[0]):
+        lat, lng = int(round(lat * SCALE)), int(round(lng * SCALE))
+        _varint(out, sid - p_sid)
+        _varint(out, _zigzag(lat - p_lat))
+        _varint(out, _zigzag(lng - p_lng))
+        _varint(out, max(int(round(speed or 0)), 0))
+        p_sid, p_lat, p_lng = sid, lat, lng
+    return bytes(out)
+
+
+def decode_frame(data):
+    """Inverse of encode_frame: (route_id, t, [[sid, lat, lng, speed], ...])."""
+    pos = 1
+
+    def read():
+        nonlocal pos
+        n = shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if b < 0x80:
+                return n
+
+    def signed():
+        n = read()
+        return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+    if data[0] != VERSION:
+        raise ValueError(f"unknown frame version {data[0]}")
+    route_id, t, count = read(), read() / 10, read()
+    buses, sid, lat, lng = [], 0, 0, 0
+    for _ in range(count):
+        sid += read()
+        lat += signed()
+        lng += signed()
+        buses.append([sid, lat / SCALE, lng / SCALE, read()])
+    return route_id, t, buses
+
+
+def encode_text(route_id, t, buses):
+    return base64.b64encode(encode_frame(route_id, t, buses)).decode("ascii")
+
+
+def decode_text(text):
+    return decode_frame(base64.b64decode(text))